@@ -0,0 +1,51 @@
+"""
+sentry_hipchat_ac.bench
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Helpers for the load tests and benchmarks that are exposed as management
+commands.  None of this is used at runtime.
+"""
+from contextlib import contextmanager
+
+from sentry_hipchat_ac import stats
+
+
+def format_latencies(values):
+    """Formats a list of durations in seconds as a percentile summary."""
+    if not values:
+        return 'no requests'
+    return 'p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms (n=%d)' % (
+        stats.percentile(values, 50) * 1000,
+        stats.percentile(values, 90) * 1000,
+        stats.percentile(values, 99) * 1000,
+        max(values) * 1000,
+        len(values),
+    )
+
+
+@contextmanager
+def budget_violations(enabled=True):
+    """Collects the paths going over their budgets while the block runs
+    if `enabled`.  Collecting makes every path record its timings, which
+    slows it down a little.
+    """
+    if not enabled:
+        yield []
+        return
+    with stats.collect_budget_violations() as rv:
+        yield rv
+
+
+def summarize_budget_violations(violations):
+    """Groups the violations collected with
+    `stats.collect_budget_violations` by path and section.  Returns a list
+    of lines with how often each budget was exceeded and the worst count.
+    """
+    grouped = {}
+    for violation in violations:
+        rv = grouped.setdefault((violation['path'], violation['section']),
+                                [0, 0, violation['limit']])
+        rv[0] += 1
+        rv[1] = max(rv[1], violation['count'])
+    return ['%s %s: exceeded %d times, up to %d (budget %d)' % (
+        key + tuple(value)) for key, value in sorted(grouped.items())]
@@ -0,0 +1,165 @@
+"""
+sentry_hipchat_ac.bench.fakehipchat
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A stand-in for the parts of the HipChat API the add-on talks to, with
+configurable latency and error injection.  It is meant for load testing
+and benchmarks only.
+"""
+import re
+import json
+import time
+import random
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+_routes = [
+    ('POST', re.compile(r'^/v2/oauth/token$'), 'token'),
+    ('POST', re.compile(r'^/v2/room/[^/]+/notification$'), 'notification'),
+    ('POST', re.compile(r'^/v2/addon/ui/room/[^/]+$'), 'glance'),
+    ('GET', re.compile(r'^/v2/room/(?P<room_id>[^/]+)$'), 'room'),
+]
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body=None, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).iteritems():
+            self.send_header(key, value)
+        if body is not None:
+            body = json.dumps(body)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        else:
+            self.send_header('Content-Length', '0')
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def _dispatch(self, method):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        for route_method, route_re, endpoint in _routes:
+            match = route_re.match(self.path.split('?', 1)[0])
+            if route_method == method and match is not None:
+                break
+        else:
+            fake.record('unknown', 404)
+            return self._respond(404, {'error': 'not found'})
+
+        delay = fake.latency + random.random() * fake.jitter
+        if delay:
+            time.sleep(delay)
+
+        roll = random.random()
+        if roll < fake.rate_limit_rate:
+            fake.record(endpoint, 429)
+            return self._respond(429, {'error': 'rate limited'},
+                                 headers={'Retry-After': '1'})
+        if roll < fake.rate_limit_rate + fake.error_rate:
+            fake.record(endpoint, 500)
+            return self._respond(500, {'error': 'injected error'})
+
+        fake.record(endpoint, endpoint in ('token', 'room') and 200 or 204)
+        if endpoint == 'token':
+            return self._respond(200, {
+                'access_token': 'fake-token-%s' % random.getrandbits(32),
+                'expires_in': 3600,
+            })
+        elif endpoint == 'room':
+            room_id = match.group('room_id')
+            return self._respond(200, {
+                'id': room_id,
+                'name': 'Room %s' % room_id,
+                'owner': {'id': 1, 'name': 'Fake Owner'},
+            })
+        return self._respond(204)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+
+class FakeHipChat(object):
+    """Runs a fake HipChat API server on a background thread.
+
+    `latency` is the base delay of every response in seconds and `jitter`
+    the maximum of a random delay added on top.  `error_rate` and
+    `rate_limit_rate` are the fractions of requests answered with a 500 or
+    a 429 respectively.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, rate_limit_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%s' % (host, port)
+
+    def get_capdoc(self):
+        """Returns a capabilities document pointing at this server, as
+        accepted by `Tenant.objects.create`.
+        """
+        return {
+            'links': {
+                'self': '%s/v2/capabilities' % self.url,
+                'homepage': self.url,
+            },
+            'capabilities': {
+                'oauth2Provider': {
+                    'tokenUrl': '%s/v2/oauth/token' % self.url,
+                },
+                'hipchatApiProvider': {
+                    'url': '%s/v2/' % self.url,
+                },
+            },
+        }
+
+    def record(self, endpoint, status):
+        with self._lock:
+            key = (endpoint, status)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def serve_forever(self):
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
@@ -0,0 +1,123 @@
+import time
+import random
+from contextlib import contextmanager
+from uuid import uuid4
+
+from redis.connection import Connection
+
+from sentry_hipchat_ac import mentions
+from sentry_hipchat_ac.utils import cluster
+
+
+class _Stub(object):
+    """Stands in for tenants, projects, groups and events, of which the
+    mention store only ever looks at the id.
+    """
+
+    def __init__(self, id):
+        self.id = id
+
+
+@contextmanager
+def count_round_trips():
+    """Counts the packets sent to Redis while the block runs.  A pipeline
+    counts as one round trip per host.
+    """
+    counter = [0]
+    original = Connection.send_packed_command
+
+    def send_packed_command(self, command):
+        counter[0] += 1
+        return original(self, command)
+
+    Connection.send_packed_command = send_packed_command
+    try:
+        yield counter
+    finally:
+        Connection.send_packed_command = original
+
+
+def _get_server_stat(name):
+    rv = 0
+    for host_id in cluster.hosts:
+        rv += int(cluster.get_local_client(host_id).info()[name])
+    return rv
+
+
+def _measure(name, count, f):
+    commands = _get_server_stat('total_commands_processed')
+    with count_round_trips() as round_trips:
+        start = time.time()
+        for idx in xrange(count):
+            f(idx)
+        elapsed = time.time() - start
+    # The INFO calls themselves are processed commands as well.
+    commands = _get_server_stat('total_commands_processed') - commands - \
+        2 * len(cluster.hosts)
+    return {
+        'operation': name,
+        'count': count,
+        'ops_per_sec': count / max(elapsed, 1e-9),
+        'round_trips_per_op': round_trips[0] / float(count or 1),
+        'commands_per_op': commands / float(count or 1),
+    }
+
+
+# A snapshot of typical size so the memory use is realistic.
+SNAPSHOT = {
+    'title': 'TypeError: Cannot read property \'length\' of undefined',
+    'culprit': 'app/components/list in renderItems',
+    'level': 'error',
+    'project_name': 'Frontend',
+    'project_link': 'https://sentry.example.com/acme/frontend/',
+    'times_seen': 1234,
+    'link': 'https://sentry.example.com/acme/frontend/group/12345/',
+    'event_id': 67890,
+}
+
+
+def run_mentions_benchmark(tenants=100, operations=10000, groups=1000,
+                           projects=10, burst=1):
+    """Benchmarks the mention store with synthetic tenants.  Mentions are
+    recorded for random tenants; with a `burst` larger than one every
+    tenant that is picked receives that many mentions in a row, as it
+    happens during an incident.  Returns a tuple of the per-operation
+    results and the Redis memory used per tenant in bytes.
+    """
+    tenants = [_Stub('bench-%s' % uuid4().hex) for _ in xrange(tenants)]
+    projects = [_Stub(idx + 1) for idx in xrange(projects)]
+    groups = [_Stub(idx + 1) for idx in xrange(groups)]
+    rng = random.Random(42)
+
+    def mention(idx):
+        if idx % burst == 0:
+            mention.tenant = rng.choice(tenants)
+        group = rng.choice(groups)
+        mentions.mention_event(
+            project=projects[group.id % len(projects)],
+            group=group,
+            tenant=mention.tenant,
+            event=_Stub(rng.randint(1, 1 << 30)),
+            snapshot=dict(SNAPSHOT, refreshed=time.time()),
+        )
+
+    memory = _get_server_stat('used_memory')
+    results = []
+    try:
+        results.append(_measure('mention_event', operations, mention))
+        memory = (_get_server_stat('used_memory') - memory) / len(tenants)
+        results.append(_measure(
+            'count_recent_mentions', operations,
+            lambda idx: mentions.count_recent_mentions(rng.choice(tenants))))
+        results.append(_measure(
+            'get_recent_mentions', max(1, operations // 10),
+            lambda idx: mentions.get_recent_mentions(rng.choice(tenants))))
+        results.append(_measure(
+            'clear_project_mentions', len(tenants),
+            lambda idx: mentions.clear_project_mentions(
+                tenants[idx], [rng.choice(projects)])))
+    finally:
+        for tenant in tenants:
+            mentions.clear_tenant_mentions(tenant)
+
+    return results, memory
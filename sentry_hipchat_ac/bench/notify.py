@@ -0,0 +1,129 @@
+import time
+import threading
+from Queue import Queue
+from uuid import uuid4
+
+from django.db import connection
+
+from sentry.models import Event, Group
+from sentry.plugins import plugins
+
+from sentry_hipchat_ac import cooldown
+from sentry_hipchat_ac.models import Tenant
+from sentry_hipchat_ac.plugin import update_tenant_projects
+
+
+def create_tenants(fake, count, projects=()):
+    """Creates `count` tenants installed from the given fake HipChat server
+    and subscribes them to `projects`.
+    """
+    rv = []
+    for idx in xrange(count):
+        tenant = Tenant.objects.create(
+            id='bench-%s' % uuid4().hex,
+            secret=uuid4().hex,
+            room_id=str(idx + 1),
+            capdoc=fake.get_capdoc(),
+        )
+        if projects:
+            update_tenant_projects(tenant, add=projects)
+        rv.append(tenant)
+    return rv
+
+
+def delete_tenants(tenants):
+    for tenant in tenants:
+        tenant.delete()
+
+
+def load_events(project, limit):
+    """Loads the most recent events of a project with their groups and
+    node data so they can be replayed.
+    """
+    events = list(Event.objects.filter(
+        project=project).order_by('-id')[:limit])
+    groups = Group.objects.in_bulk(set(x.group_id for x in events))
+    Event.objects.bind_nodes(events, 'data')
+    rv = []
+    for event in events:
+        event.project = project
+        event.group = groups[event.group_id]
+        rv.append((event.group, event))
+    return rv
+
+
+def run_notify_benchmark(events, rate, duration, workers, group_cooldown=0):
+    """Calls `HipchatNotifier.notify_users` for the given ``(group, event)``
+    tuples at `rate` events per second for `duration` seconds on
+    `workers` threads.  The events are replayed over and over, so the
+    per-room cooldown of groups is set to `group_cooldown` seconds for the
+    run, by default disabled.  Returns a dictionary with the number of
+    events queued, the per-event latencies, the number of failures and
+    the total time including draining the queue.
+    """
+    old_cooldown = cooldown.GROUP_COOLDOWN
+    cooldown.GROUP_COOLDOWN = group_cooldown
+    try:
+        return _run_notify_benchmark(events, rate, duration, workers)
+    finally:
+        cooldown.GROUP_COOLDOWN = old_cooldown
+
+
+def _run_notify_benchmark(events, rate, duration, workers):
+    plugin = plugins.get('hipchat-ac')
+    queue = Queue()
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                group, event = item
+                start = time.time()
+                try:
+                    plugin.notify_users(group, event)
+                except Exception:
+                    with lock:
+                        failures[0] += 1
+                else:
+                    with lock:
+                        latencies.append(time.time() - start)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in xrange(workers)]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    queued = 0
+    while time.time() - start < duration:
+        due = int((time.time() - start) * rate)
+        while queued < due:
+            queue.put(events[queued % len(events)])
+            queued += 1
+        time.sleep(min(0.01, 1.0 / rate))
+
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+
+    return {
+        'queued': queued,
+        'latencies': latencies,
+        'failures': failures[0],
+        'elapsed': time.time() - start,
+    }
+
+
+def count_deliveries(fake):
+    """Returns the number of notifications the fake HipChat server
+    accepted.
+    """
+    return sum(count for (endpoint, status), count in fake.counts.items()
+               if endpoint == 'notification' and status < 300)
@@ -0,0 +1,164 @@
+import json
+import time
+import random
+import threading
+from urlparse import urlparse
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from sentry.utils.http import absolute_uri
+
+from sentry_hipchat_ac import mentions
+from sentry_hipchat_ac.bench.notify import create_tenants
+
+
+VIEWS = ('recent_events_glance', 'recent_events', 'event_details',
+         'assign_event', 'on_link_message')
+
+# The number of events mentioned per tenant so the sidebar has something
+# to show.
+MENTIONED_EVENTS = 10
+
+
+def create_view_tenants(fake, count, project, user, events):
+    """Creates `count` tenants like `create_tenants` that are authorized
+    as `user` for the organization of the project and have some of the
+    events mentioned already.
+    """
+    tenants = create_tenants(fake, count, [project])
+    for tenant in tenants:
+        tenant.auth_user = user
+        tenant.save()
+        tenant.organizations.add(project.organization)
+        for group, event in events[:MENTIONED_EVENTS]:
+            mentions.mention_event(project=project, group=group,
+                                   tenant=tenant, event=event)
+    return tenants
+
+
+def make_link(group, event=None):
+    """Returns the Sentry URL of a group or event that messages link."""
+    project = group.project
+    path = '/%s/%s/group/%s/' % (project.organization.slug, project.slug,
+                                 group.id)
+    if event is not None:
+        path += 'events/%s/' % event.id
+    return absolute_uri(path)
+
+
+def make_link_message(tenant, user_id, events):
+    """Returns the body of a ``room_message`` webhook for a message with
+    links to the given ``(group, event)`` tuples.  The body carries no
+    ``oauth_client_id`` so the tenant is looked up from the JWT.
+    """
+    return {
+        'event': 'room_message',
+        'webhook_id': 1,
+        'item': {
+            'message': {
+                'id': uuid4().hex,
+                'message': 'Look at %s' % ' and '.join(
+                    make_link(group, event) for group, event in events),
+                'from': {
+                    'id': user_id,
+                    'name': 'Bench User',
+                    'mention_name': 'bench',
+                },
+            },
+            'room': {'id': tenant.room_id},
+        },
+    }
+
+
+class _Session(object):
+    """Sends the requests of one simulated HipChat user."""
+
+    def __init__(self, tenants, events, links, host, seed):
+        self.client = Client(HTTP_HOST=host)
+        self.tenants = tenants
+        self.events = events
+        self.links = links
+        self.rng = random.Random(seed)
+        self.user_id = self.rng.randint(1, 1 << 20)
+
+    def signed_get(self, tenant, view, **params):
+        params['signed_request'] = tenant.sign_jwt(self.user_id)
+        return self.client.get(reverse(view), params)
+
+    def request(self, view):
+        tenant = self.rng.choice(self.tenants)
+        group, event = self.rng.choice(self.events)
+        if view == 'recent_events_glance':
+            return self.signed_get(
+                tenant, 'sentry-hipchat-ac-recent-events-glance')
+        elif view == 'recent_events':
+            return self.signed_get(tenant, 'sentry-hipchat-ac-recent-events')
+        elif view == 'event_details':
+            return self.signed_get(tenant, 'sentry-hipchat-ac-event-details',
+                                   event=event.id)
+        elif view == 'assign_event':
+            return self.signed_get(tenant, 'sentry-hipchat-assign-event',
+                                   event=event.id)
+        elif view == 'on_link_message':
+            body = make_link_message(
+                tenant, self.user_id,
+                self.rng.sample(self.events, min(self.links,
+                                                 len(self.events))))
+            return self.client.post(
+                reverse('sentry-hipchat-ac-link-message'),
+                json.dumps(body), content_type='application/json',
+                HTTP_AUTHORIZATION='JWT %s' % tenant.sign_jwt(self.user_id))
+        raise ValueError('Unknown view %r' % view)
+
+
+def run_views_benchmark(tenants, events, views=VIEWS, concurrency=4,
+                        duration=10.0, links=1):
+    """Sends signed requests to the add-on views for `duration` seconds
+    from `concurrency` threads, each picking a random view, tenant and
+    event for every request.  Link messages are only handed to a worker
+    by the view unless Celery runs tasks eagerly.  Returns a dictionary
+    that maps the views to their latencies and status code counts, and
+    the total time.
+    """
+    host = urlparse(settings.SENTRY_URL_PREFIX).netloc or 'testserver'
+    results = dict((view, {'latencies': [], 'statuses': {}})
+                   for view in views)
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def worker(seed):
+        session = _Session(tenants, events, links, host, seed)
+        rng = random.Random(seed)
+        try:
+            while time.time() < stop_at:
+                view = rng.choice(views)
+                start = time.time()
+                try:
+                    status = session.request(view).status_code
+                except Exception:
+                    status = 'error'
+                elapsed = time.time() - start
+                with lock:
+                    result = results[view]
+                    result['latencies'].append(elapsed)
+                    result['statuses'][status] = \
+                        result['statuses'].get(status, 0) + 1
+        finally:
+            connection.close()
+
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(idx,))
+               for idx in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'views': results,
+        'elapsed': time.time() - start,
+    }
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
+import json
+
+from django.conf import settings
 from django.utils.html import escape
 
 from sentry.models import Activity, User, Event
 
+from . import stats
+
 
 ICON = 'https://sentry-hipchat-ac-assets.s3.amazonaws.com/sentry-icon.png'
 ICON2X = 'https://sentry-hipchat-ac-assets.s3.amazonaws.com/sentry-icon.png'
@@ -16,6 +21,31 @@ COLORS = {
     'DEBUG': 'purple',
 }
 
+LEVEL_STYLES = {
+    'critical': 'lozenge-error',
+    'fatal': 'lozenge-error',
+    'error': 'lozenge-error',
+    'warning': 'lozenge-current',
+    'debug': 'lozenge-moved',
+}
+
+# The size in bytes a serialized notification should stay below.  Larger
+# notifications lose their least important card attributes, and if that is
+# not enough, the card.
+MAX_PAYLOAD_SIZE = getattr(settings, 'HIPCHAT_SENTRY_AC_MAX_PAYLOAD_SIZE',
+                           10000)
+
+# Longer strings from events are truncated.
+MAX_STRING_LENGTH = 250
+
+# Card attributes that are kept the longest when a payload is too large.
+# All others are dropped from the last one onwards.
+PRIORITY_ATTRIBUTES = ['title', 'culprit', 'level', 'release', 'environment']
+
+# Levels from most to least severe, used to pick a color for notifications
+# that cover more than one event.
+SEVERITY = ['ALERT', 'ERROR', 'WARNING', 'INFO', 'DEBUG']
+
 
 def _format_user(user):
     if user is None:
@@ -31,16 +61,27 @@ def _format_user(user):
     return '<em>%s</em>' % escape(name)
 
 
-def _make_event_card(group, event, title=None, subtitle=None,
-                     event_target=False, new=False, description=None,
-                     compact=False):
-    project = event.project
+def _truncate(value, length=MAX_STRING_LENGTH):
+    if value is not None and len(value) > length:
+        return value[:length - 3] + '...'
+    return value
+
+
+def _make_event_link(group, event, event_target=False):
     link = group.get_absolute_url()
     if event_target:
         link = '%s/events/%s/' % (
             link.rstrip('/'),
             event.id
         )
+    return link
+
+
+def _make_event_card(group, event, title=None, subtitle=None,
+                     event_target=False, new=False, description=None,
+                     compact=False):
+    project = event.project
+    link = _make_event_link(group, event, event_target)
 
     event_title = '%sSentry %s Issue' % (
         new and 'New ' or '',
@@ -55,16 +96,10 @@ def _make_event_card(group, event, title=None, subtitle=None,
             key = key.split(':', 1)[1]
         attr = {
             'label': key,
-            'value': {'label': value}
+            'value': {'label': _truncate(value)}
         }
         if key == 'level':
-            attr_color = {
-                'critical': 'lozenge-error',
-                'fatal': 'lozenge-error',
-                'error': 'lozenge-error',
-                'warning': 'lozenge-current',
-                'debug': 'lozenge-moved',
-            }.get(value.lower())
+            attr_color = LEVEL_STYLES.get(value.lower())
             if attr_color is not None:
                 attr['value']['style'] = attr_color
         elif key == 'release':
@@ -86,7 +121,7 @@ def _make_event_card(group, event, title=None, subtitle=None,
     if description is None:
         description = '<a href="%(link)s"><em>%(err)s</em></a>' % {
             'link': escape(link),
-            'err': escape(event.error()),
+            'err': escape(_truncate(event.error())),
         }
     if description:
         description = '<p>%s</p>' % description
@@ -102,15 +137,15 @@ def _make_event_card(group, event, title=None, subtitle=None,
         ''' % {
             'project': escape(project.name),
             'project_link': escape(project.get_absolute_url()),
-            'culprit': escape(event.culprit),
+            'culprit': escape(_truncate(event.culprit)),
         }
     else:
         attributes = [{
             'label': 'culprit',
-            'value': {'label': event.culprit},
+            'value': {'label': _truncate(event.culprit)},
         }, {
             'label': 'title',
-            'value': {'label': event.error()},
+            'value': {'label': _truncate(event.error())},
         }] + attributes
 
     return {
@@ -151,41 +186,105 @@ def _make_event_card(group, event, title=None, subtitle=None,
     }
 
 
-def make_event_notification(group, event, tenant, new=True, event_target=False):
+def make_event_notification(group, event, tenant=None, new=True,
+                            event_target=False, suppressed=0):
     project = event.project
     level = group.get_level_display().upper()
-
-    link = group.get_absolute_url()
-    if event_target:
-        link = '%s/events/%s/' % (
-            link.rstrip('/'),
-            event.id
-        )
-
+    link = _make_event_link(group, event, event_target)
     color = COLORS.get(level, 'purple')
 
+    subtitle = None
+    if suppressed:
+        subtitle = '+%d more since last alert' % suppressed
+
     # Legacy message
     message = (
         '[%(level)s]%(project_name)s %(message)s '
-        '[<a href="%(link)s">view</a>]'
+        '[<a href="%(link)s">view</a>]%(subtitle)s'
     ) % {
         'level': escape(level),
         'project_name': '<strong>%s</strong>' % escape(project.name),
-        'message': escape(event.error()),
+        'message': escape(_truncate(event.error())),
         'link': escape(link),
+        'subtitle': subtitle and ' (%s)' % subtitle or '',
     }
 
     return {
         'color': color,
         'message': message,
         'format': 'html',
-        'card': _make_event_card(group, event, new=new,
+        'card': _make_event_card(group, event, new=new, subtitle=subtitle,
                                  event_target=event_target),
         'notify': True,
     }
 
 
-def make_activity_notification(activity, tenant):
+def make_event_list_notification(events):
+    """Creates a single notification for a list of ``(event, event_target)``
+    tuples, as used when a message mentions more than one event.
+    """
+    levels = []
+    items = []
+    attributes = []
+
+    for event, event_target in events:
+        group = event.group
+        level = group.get_level_display().upper()
+        link = _make_event_link(group, event, event_target)
+        levels.append(level)
+        items.append(
+            '<li>[%(level)s] <strong>%(project_name)s</strong> '
+            '<a href="%(link)s">%(message)s</a>' % {
+                'level': escape(level),
+                'project_name': escape(event.project.name),
+                'message': escape(_truncate(event.error())),
+                'link': escape(link),
+            })
+        attr = {
+            'label': event.project.name,
+            'value': {'label': _truncate(event.error()), 'url': link},
+        }
+        attr_color = LEVEL_STYLES.get(level.lower())
+        if attr_color is not None:
+            attr['value']['style'] = attr_color
+        attributes.append(attr)
+
+    level = min(levels, key=lambda x: SEVERITY.index(x)
+                if x in SEVERITY else len(SEVERITY))
+    title = '%d Sentry Issues' % len(events)
+    message = '<strong>%s</strong><ul>%s</ul>' % (title, ''.join(items))
+
+    return {
+        'color': COLORS.get(level, 'purple'),
+        'message': message,
+        'format': 'html',
+        'card': {
+            'style': 'application',
+            'id': 'sentry/%s' % ','.join(str(x.id) for x, _ in events),
+            'title': title,
+            'description': 'Sentry issues mentioned in this message.',
+            'images': {},
+            'icon': {
+                'url': ICON,
+                'url@2x': ICON2X,
+            },
+            'metadata': {
+                'sentry_message_type': 'event_list',
+            },
+            'attributes': attributes,
+            'activity': {
+                'html': message,
+            },
+        },
+        'notify': True,
+    }
+
+
+# The activities that are sent to rooms.
+ACTIVITY_TYPES = (Activity.ASSIGNED, Activity.UNASSIGNED, Activity.NOTE)
+
+
+def _describe_activity(activity):
     if activity.type in (Activity.UNASSIGNED, Activity.ASSIGNED):
         if activity.type == Activity.ASSIGNED:
             assignee_id = activity.data.get('assignee')
@@ -195,25 +294,50 @@ def make_activity_notification(activity, tenant):
         if assignee_id is None:
             target_user = None
         else:
-            target_user = User.objects.get(pk=assignee_id)
+            target_user = User.objects.filter(pk=assignee_id).first()
         if target_user is None:
-            message = '%s unassigned a user from the event' % (
+            return '%s unassigned a user from the event' % (
                 _format_user(activity.user),)
         elif activity.user is not None and target_user.id == activity.user.id:
-            message = '%s assigned themselves to the event' % (
+            return '%s assigned themselves to the event' % (
                 _format_user(activity.user),)
-        else:
-            message = '%s assigned %s to the event' % (
-                _format_user(activity.user),
-                _format_user(target_user))
+        return '%s assigned %s to the event' % (
+            _format_user(activity.user),
+            _format_user(target_user))
     elif activity.type == Activity.NOTE:
-        message = '%s left a note on the event' % (
+        return '%s left a note on the event' % (
             _format_user(activity.user),)
-    else:
+
+
+def make_activity_notification(activity, tenant=None):
+    if activity.type not in ACTIVITY_TYPES:
         return
+    return _make_activity_notification(activity, _describe_activity(activity))
+
 
+def make_activity_summary_notification(activities):
+    """Summarizes activities on the same group in one notification.  It
+    shows the final assignment if the assignee changed, the last note
+    otherwise, and how many changes there were.
+    """
+    activities = [x for x in activities if x.type in ACTIVITY_TYPES]
+    if not activities:
+        return
+
+    assignments = [x for x in activities if x.type != Activity.NOTE]
+    activity = (assignments or activities)[-1]
+    message = _describe_activity(activity)
+    if len(activities) > 1:
+        message = '%s (%d changes)' % (message, len(activities))
+    return _make_activity_notification(activity, message)
+
+
+def _make_activity_notification(activity, message):
     event = activity.group.get_latest_event()
-    Event.objects.bind_nodes([event], 'data')
+    if event is None:
+        return
+    with stats.timer('nodestore'):
+        Event.objects.bind_nodes([event], 'data')
     project = activity.project
     link = activity.group.get_absolute_url()
 
@@ -222,9 +346,9 @@ def make_activity_notification(activity, tenant):
         '[<a href="%(link)s">view</a>]'
     ) % {
         'project_name': '<strong>%s</strong>' % escape(project.name),
-        'event': escape(event.error()),
+        'event': escape(_truncate(event.error())),
         'message': message,
-        'culprit': escape(event.culprit),
+        'culprit': escape(_truncate(event.culprit)),
         'link': escape(link),
     }
 
@@ -232,8 +356,9 @@ def make_activity_notification(activity, tenant):
         'color': 'yellow',
         'message': legacy_message,
         'card': _make_event_card(activity.group, event, title=message,
-                                 subtitle='%s, %s' % (event.error(),
-                                                      event.culprit),
+                                 subtitle='%s, %s' % (
+                                     _truncate(event.error()),
+                                     _truncate(event.culprit)),
                                  compact=True),
         'format': 'html',
         'notify': False,
@@ -271,3 +396,54 @@ def make_generic_notification(text, color=None, notify=False):
         'color': color,
         'notify': notify,
     }
+
+
+def serialize_notification(message, color='yellow', notify=False,
+                           format='html', card=None):
+    """Serializes a notification as returned by the functions above into
+    the body of a room notification request.  Notifications that go to
+    more than one room should only be serialized once.
+    """
+    data = {'message': message, 'format': format, 'notify': notify}
+    if color is not None:
+        data['color'] = color
+    if card is not None:
+        data['card'] = card
+    rv = json.dumps(data)
+
+    if len(rv) > MAX_PAYLOAD_SIZE and card is not None:
+        rv = _compact_notification(data, len(rv) - MAX_PAYLOAD_SIZE)
+        stats.incr('payload.compacted')
+    stats.timing('payload.size', len(rv))
+    return rv
+
+
+def _get_attribute_priority(attr):
+    if attr['label'] in PRIORITY_ATTRIBUTES:
+        return PRIORITY_ATTRIBUTES.index(attr['label'])
+    return len(PRIORITY_ATTRIBUTES)
+
+
+def _compact_notification(data, excess):
+    card = data['card'] = dict(data['card'])
+    attributes = card.get('attributes') or []
+
+    # Drop the least important attributes until roughly `excess` bytes
+    # are saved.
+    ranked = sorted(xrange(len(attributes)), key=lambda idx: (
+        _get_attribute_priority(attributes[idx]), idx))
+    dropped = set()
+    saved = 0
+    for idx in reversed(ranked):
+        if saved >= excess:
+            break
+        dropped.add(idx)
+        saved += len(json.dumps(attributes[idx])) + 2
+    card['attributes'] = [x for idx, x in enumerate(attributes)
+                          if idx not in dropped]
+
+    rv = json.dumps(data)
+    if len(rv) > MAX_PAYLOAD_SIZE:
+        del data['card']
+        rv = json.dumps(data)
+    return rv
@@ -0,0 +1,51 @@
+from django.conf import settings
+
+from . import stats
+from .utils import cluster
+
+
+# For how many seconds activities on a group are collected before a single
+# notification summarizing them is sent.  0 sends every activity right
+# away.
+ACTIVITY_WINDOW = getattr(settings, 'HIPCHAT_SENTRY_AC_ACTIVITY_WINDOW', 10)
+
+# Collected activities are given up on if no flush picks them up.
+ACTIVITY_TTL = 60 * 60
+
+
+def _get_key(group_id):
+    return 'sentry-hipchat-ac:activities:%s' % group_id
+
+
+@stats.timed('redis', section=False)
+def buffer_activity(activity):
+    """Collects an activity for a later summary.  Returns `True` if it is
+    the first one of its group in the current window, in which case the
+    caller has to schedule the flush.
+    """
+    key = _get_key(activity.group_id)
+    with cluster.map() as client:
+        client.rpush(key, activity.id)
+        client.expire(key, ACTIVITY_TTL)
+        # If the flush of a window gets lost the next activity opens a
+        # new window soon after instead of being buffered for good.
+        first = client.set('%s:window' % key, '1',
+                           ex=ACTIVITY_WINDOW * 2, nx=True)
+    return bool(first.value)
+
+
+@stats.timed('redis', section=False)
+def pop_activities(group_id):
+    """Returns the ids of the activities collected for a group in order
+    and starts a new window.
+    """
+    key = _get_key(group_id)
+    with cluster.map() as client:
+        client.delete('%s:window' % key)
+        ids = client.lrange(key, 0, -1)
+    ids = ids.value
+    if ids:
+        # Activities collected in the meantime are left for the next
+        # window.
+        cluster.get_routing_client().ltrim(key, len(ids), -1)
+    return [int(x) for x in ids]
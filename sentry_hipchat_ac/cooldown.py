@@ -0,0 +1,47 @@
+from django.conf import settings
+
+from . import stats
+from .utils import cluster
+
+
+# For how many seconds after a notification about a group further events
+# of that group are not sent to the same room.  They are counted instead
+# and the count is shown on the next notification.  0 disables this.
+GROUP_COOLDOWN = getattr(settings, 'HIPCHAT_SENTRY_AC_GROUP_COOLDOWN', 60)
+
+# Suppressed counts are kept for a day at most.
+SUPPRESSED_TTL = 24 * 60 * 60
+
+
+def _get_key(tenant, group):
+    return 'sentry-hipchat-ac:%s:cooldown:%s' % (tenant.id, group.id)
+
+
+@stats.timed('redis', section=False)
+def check_cooldowns(tenants, group):
+    """Checks for which of the tenants a notification about the group may
+    be sent right now.  Returns a dictionary that maps the ids of those
+    tenants to the number of occurrences suppressed since their last
+    notification.  Tenants that are still cooling down are left out and
+    have the occurrence counted.
+    """
+    if not GROUP_COOLDOWN:
+        return dict((x.id, 0) for x in tenants)
+
+    with cluster.map() as client:
+        claims = [(tenant, client.set(_get_key(tenant, group), '1',
+                                      ex=GROUP_COOLDOWN, nx=True))
+                  for tenant in tenants]
+
+    rv = {}
+    with cluster.map() as client:
+        for tenant, claim in claims:
+            key = '%s:suppressed' % _get_key(tenant, group)
+            if claim.value:
+                rv[tenant.id] = client.getset(key, 0)
+                client.expire(key, SUPPRESSED_TTL)
+            else:
+                client.incr(key)
+                client.expire(key, SUPPRESSED_TTL)
+
+    return dict((k, int(v.value or 0)) for k, v in rv.iteritems())
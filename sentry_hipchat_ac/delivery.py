@@ -0,0 +1,349 @@
+import json
+import time
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.utils.timezone import utc
+
+from . import stats
+from .utils import cluster
+
+
+# After how many consecutive failed requests to a HipChat server the
+# circuit breaker opens, and for how many seconds it stays open before a
+# single probe request is let through.
+BREAKER_THRESHOLD = getattr(settings, 'HIPCHAT_SENTRY_AC_BREAKER_THRESHOLD', 5)
+BREAKER_RESET_TIMEOUT = getattr(
+    settings, 'HIPCHAT_SENTRY_AC_BREAKER_RESET_TIMEOUT', 30)
+
+# How long a probe request may take before another one is allowed.
+PROBE_TIMEOUT = 15
+
+# How many deliveries are kept per server while its breaker is open and
+# for how many seconds.
+DEFERRED_MAX = 1000
+DEFERRED_TTL = 60 * 60
+
+# Bounds in seconds for the read timeout of requests to HipChat servers.
+# Within them the timeout follows the p99 latency of each server.
+MIN_TIMEOUT = getattr(settings, 'HIPCHAT_SENTRY_AC_MIN_TIMEOUT', 1.0)
+MAX_TIMEOUT = getattr(settings, 'SENTRY_HIPCHAT_TIMEOUT', 3)
+CONNECT_TIMEOUT = getattr(settings, 'HIPCHAT_SENTRY_AC_CONNECT_TIMEOUT', 1.0)
+TIMEOUT_FACTOR = 2.0
+
+# Outbound requests are sorted into lanes by priority.  Alerts about new
+# events are never held back.  The other lanes have fewer concurrent
+# requests per process and only get the given share of the requests a
+# HipChat server accepts per window.  Activity and system notifications
+# over their share are deferred, glances are dropped.
+LANE_ALERT = 'alert'
+LANE_SYSTEM = 'system'
+LANE_ACTIVITY = 'activity'
+LANE_GLANCE = 'glance'
+
+LANE_CONCURRENCY = dict({
+    LANE_ALERT: 16,
+    LANE_SYSTEM: 8,
+    LANE_ACTIVITY: 4,
+    LANE_GLANCE: 2,
+}, **getattr(settings, 'HIPCHAT_SENTRY_AC_LANE_CONCURRENCY', {}))
+LANE_SHARES = {
+    LANE_ALERT: None,
+    LANE_SYSTEM: 1.0,
+    LANE_ACTIVITY: 0.5,
+    LANE_GLANCE: 0.25,
+}
+
+# The number of requests per window in seconds that a HipChat server is
+# sent by all workers together before lanes are held back.  0 disables
+# the rate budget.
+SERVER_RATE_LIMIT = getattr(settings, 'HIPCHAT_SENTRY_AC_SERVER_RATE_LIMIT',
+                            1000)
+RATE_WINDOW = 60
+
+# How many of the most recent requests are logged per tenant for the
+# configuration page and for how many seconds.
+DELIVERY_LOG_SIZE = getattr(settings, 'HIPCHAT_SENTRY_AC_DELIVERY_LOG_SIZE',
+                            100)
+DELIVERY_LOG_TTL = 7 * 24 * 60 * 60
+
+# The time in seconds that notifying all rooms about an event may take.
+# Rooms that are left once it is used up are notified from a worker.
+NOTIFY_DEADLINE = getattr(settings, 'HIPCHAT_SENTRY_AC_NOTIFY_DEADLINE', 10)
+
+
+def _get_breaker_key(server):
+    return 'sentry-hipchat-ac:breaker:%s' % server
+
+
+def _get_deferred_key(server):
+    return 'sentry-hipchat-ac:deferred:%s' % server
+
+
+def _get_delivery_log_key(tenant):
+    return 'sentry-hipchat-ac:%s:delivery-log' % tenant.id
+
+
+def _get_rate_key(server):
+    return 'sentry-hipchat-ac:rate:%s:%d' % (
+        server, int(time.time() // RATE_WINDOW))
+
+
+_lane_semaphores = dict((lane, threading.BoundedSemaphore(count))
+                        for lane, count in LANE_CONCURRENCY.iteritems())
+
+
+def _held_back(server, lane, reason):
+    stats.incr('lane.held_back', tags={
+        'lane': lane,
+        'reason': reason,
+        'server': stats.get_server_tag(server),
+    })
+
+
+def acquire_lane(server, lane):
+    """Takes a slot in a lane for a request to a HipChat server.  Alerts
+    wait for a slot, the other lanes do not.  Returns `False` if the
+    request has to be held back; otherwise `release_lane` has to be called
+    once the request is done.
+    """
+    if _lane_semaphores[lane].acquire(lane == LANE_ALERT):
+        return True
+    _held_back(server, lane, 'concurrency')
+    return False
+
+
+@stats.timed('redis', section=False)
+def admit(breaker, lane):
+    """Checks the circuit breaker of a HipChat server and takes a slot in
+    the server's rate budget, both in one round trip.  Returns `None` if
+    the request may be sent, otherwise why it has to be held back:
+    ``breaker`` or ``rate``.  Alerts are never held back by the budget,
+    they are counted against it by `log_delivery` once sent.
+    """
+    limited = bool(SERVER_RATE_LIMIT) and LANE_SHARES[lane] is not None
+    key = _get_rate_key(breaker.server)
+    with cluster.map() as client:
+        state = client.hgetall(breaker.key)
+        if limited:
+            count = client.incr(key)
+            client.expire(key, RATE_WINDOW * 2)
+
+    if not breaker.allow(state.value):
+        reason = 'breaker'
+    elif limited and count.value > SERVER_RATE_LIMIT * LANE_SHARES[lane]:
+        reason = 'rate'
+        _held_back(breaker.server, lane, reason)
+    else:
+        return None
+    # Requests that are held back do not count against the budget.
+    if limited:
+        cluster.get_routing_client().decr(key)
+    return reason
+
+
+def release_lane(lane):
+    _lane_semaphores[lane].release()
+
+
+def get_timeout(server, deadline=None):
+    """Returns the ``(connect, read)`` timeout for a request to a HipChat
+    server, optionally cut short by a `deadline` timestamp.  Returns
+    `None` if the deadline has passed.
+    """
+    p99 = stats.get_latency_percentile(server, 99)
+    if p99 is None:
+        read = MAX_TIMEOUT
+    else:
+        read = min(MAX_TIMEOUT, max(MIN_TIMEOUT, p99 * TIMEOUT_FACTOR))
+    connect = CONNECT_TIMEOUT
+
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        read = min(read, remaining)
+        connect = min(connect, remaining)
+    return connect, read
+
+
+class CircuitBreaker(object):
+    """A circuit breaker for one HipChat server with its state kept in
+    Redis so that all workers share it.  `allow` has to be called before
+    every request and the outcome reported with `record_success` or
+    `record_failure`.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.key = _get_breaker_key(server)
+        self.failures = 0
+        self.probing = False
+
+    @stats.timed('redis', section=False)
+    def allow(self, state=None):
+        """Returns `True` if a request may be sent to the server.  `state`
+        is the breaker's hash if it was fetched already.
+        """
+        client = cluster.get_routing_client()
+        if state is None:
+            state = client.hgetall(self.key)
+        self.failures = int(state.get('failures') or 0)
+        if self.failures < BREAKER_THRESHOLD:
+            return True
+        if float(state.get('opened_at') or 0) + BREAKER_RESET_TIMEOUT \
+           > time.time():
+            return False
+
+        # Half open: only one request gets to find out if the server is
+        # back.
+        self.probing = bool(client.set('%s:probe' % self.key, '1',
+                                       ex=PROBE_TIMEOUT, nx=True))
+        return self.probing
+
+    @stats.timed('redis', section=False)
+    def record_success(self):
+        """Closes the breaker.  Returns `True` if it was open before."""
+        if not self.failures:
+            return False
+        with cluster.map() as client:
+            client.delete(self.key)
+            client.delete('%s:probe' % self.key)
+        if self.failures >= BREAKER_THRESHOLD:
+            stats.incr('breaker.closed',
+                       tags={'server': stats.get_server_tag(self.server)})
+            return True
+        return False
+
+    @stats.timed('redis', section=False)
+    def record_failure(self):
+        """Counts a failure.  Returns `True` if that opened the breaker."""
+        client = cluster.get_routing_client()
+        failures = client.hincrby(self.key, 'failures', 1)
+        if failures < BREAKER_THRESHOLD or \
+           (failures > BREAKER_THRESHOLD and not self.probing):
+            client.expire(self.key, DEFERRED_TTL)
+            return False
+
+        with cluster.map() as map_client:
+            map_client.hset(self.key, 'opened_at', time.time())
+            map_client.expire(self.key, DEFERRED_TTL)
+            map_client.delete('%s:probe' % self.key)
+        stats.incr('breaker.opened',
+                   tags={'server': stats.get_server_tag(self.server)})
+        return True
+
+
+@stats.timed('redis', section=False)
+def defer(tenant, url, body, endpoint, lane=None):
+    """Stores a request for later, when the breaker of the tenant's server
+    closes again or a worker gets to it.  The flush has to be queued
+    separately, see `claim_flush`.
+    """
+    key = _get_deferred_key(tenant.installed_from)
+    with cluster.map() as client:
+        client.lpush(key, json.dumps({
+            'tenant': tenant.id,
+            'url': url,
+            'body': body,
+            'endpoint': endpoint,
+            'lane': lane,
+        }))
+        client.ltrim(key, 0, DEFERRED_MAX - 1)
+        client.expire(key, DEFERRED_TTL)
+    stats.incr('request.deferred', tags={
+        'endpoint': endpoint,
+        'server': stats.get_server_tag(tenant.installed_from),
+    })
+
+
+@stats.timed('redis', section=False)
+def claim_flush(server, countdown):
+    """Returns `True` if no flush of the server's deferred requests is
+    queued yet, in which case the caller has to queue one to run in
+    `countdown` seconds.  The claim outlives a lost flush by
+    `BREAKER_RESET_TIMEOUT` seconds at most.
+    """
+    client = cluster.get_routing_client()
+    return bool(client.set('%s:scheduled' % _get_deferred_key(server), '1',
+                           ex=countdown + BREAKER_RESET_TIMEOUT, nx=True))
+
+
+@stats.timed('redis', section=False)
+def release_flush(server):
+    """Called by the flush when it starts so the next one can be queued."""
+    cluster.get_routing_client().delete(
+        '%s:scheduled' % _get_deferred_key(server))
+
+
+@stats.timed('redis', section=False)
+def pop_deferred(server):
+    """Returns the oldest deferred request of a server or `None`."""
+    client = cluster.get_routing_client()
+    rv = client.rpop(_get_deferred_key(server))
+    if rv is not None:
+        return json.loads(rv)
+
+
+@stats.timed('redis', section=False)
+def log_delivery(tenant, endpoint, lane, status, size, duration=None,
+                 count_rate=False):
+    """Logs a request to HipChat for a tenant.  `status` is the HTTP
+    status code or one of ``timeout``, ``error``, ``deferred`` and
+    ``dropped``.  Only the last `DELIVERY_LOG_SIZE` requests are kept.
+    If `count_rate` is set the request is also counted against the rate
+    budget of the tenant's server in the same round trip.
+    """
+    key = _get_delivery_log_key(tenant)
+    with cluster.map() as client:
+        if count_rate and SERVER_RATE_LIMIT:
+            rate_key = _get_rate_key(tenant.installed_from)
+            client.incr(rate_key)
+            client.expire(rate_key, RATE_WINDOW * 2)
+        client.lpush(key, json.dumps({
+            'timestamp': time.time(),
+            'endpoint': endpoint,
+            'lane': lane,
+            'status': status,
+            'size': size,
+            'duration': duration,
+        }))
+        client.ltrim(key, 0, DELIVERY_LOG_SIZE - 1)
+        client.expire(key, DELIVERY_LOG_TTL)
+
+
+@stats.timed('redis', section=False)
+def get_delivery_log(tenant):
+    """Returns the logged requests of a tenant, newest first, and a
+    summary of them with the p50 and p95 latency in milliseconds and the
+    number of failed and held back requests.
+    """
+    client = cluster.get_routing_client()
+    entries = [json.loads(x) for x in
+               client.lrange(_get_delivery_log_key(tenant), 0, -1)]
+    for entry in entries:
+        entry['timestamp'] = datetime.fromtimestamp(entry['timestamp'], utc)
+        if entry['duration'] is not None:
+            entry['duration_ms'] = int(entry['duration'] * 1000)
+
+    durations = [x['duration'] for x in entries if x['duration'] is not None]
+    summary = {
+        'count': len(entries),
+        'failed': sum(1 for x in entries if x['status'] in (
+            'timeout', 'error') or isinstance(x['status'], int) and
+            x['status'] >= 400),
+        'held_back': sum(1 for x in entries if x['status'] in (
+            'deferred', 'dropped')),
+        'p50': None,
+        'p95': None,
+    }
+    if durations:
+        summary['p50'] = int(stats.percentile(durations, 50) * 1000)
+        summary['p95'] = int(stats.percentile(durations, 95) * 1000)
+    return entries, summary
+
+
+@stats.timed('redis', section=False)
+def clear_delivery_log(tenant):
+    cluster.get_routing_client().delete(_get_delivery_log_key(tenant))
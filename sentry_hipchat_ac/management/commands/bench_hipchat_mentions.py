@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from sentry_hipchat_ac.bench.mentionstore import run_mentions_benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the mention store against the configured Redis '
+            'with synthetic tenants.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--tenants', type='int', default=100),
+        make_option('--operations', type='int', default=10000,
+                    help='Number of operations per benchmarked call.'),
+        make_option('--groups', type='int', default=1000,
+                    help='Number of distinct groups that are mentioned.'),
+        make_option('--projects', type='int', default=10),
+        make_option('--burst', type='int', default=1,
+                    help='Number of mentions a tenant receives in a row. '
+                         'The default of 1 is a steady rate.'),
+    )
+
+    def handle(self, **options):
+        results, memory = run_mentions_benchmark(
+            tenants=options['tenants'],
+            operations=options['operations'],
+            groups=options['groups'],
+            projects=options['projects'],
+            burst=max(1, options['burst']),
+        )
+        self.stdout.write('%-24s %10s %12s %12s %12s' % (
+            'operation', 'count', 'ops/s', 'trips/op', 'commands/op'))
+        for result in results:
+            self.stdout.write('%-24s %10d %12.1f %12.2f %12.2f' % (
+                result['operation'],
+                result['count'],
+                result['ops_per_sec'],
+                result['round_trips_per_op'],
+                result['commands_per_op'],
+            ))
+        self.stdout.write('Redis memory per tenant: %.0f bytes' % memory)
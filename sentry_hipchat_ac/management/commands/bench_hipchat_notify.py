@@ -0,0 +1,102 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from sentry.models import Project
+
+from sentry_hipchat_ac.bench import format_latencies, budget_violations, \
+     summarize_budget_violations
+from sentry_hipchat_ac.bench.fakehipchat import FakeHipChat
+from sentry_hipchat_ac.bench.notify import create_tenants, delete_tenants, \
+     load_events, run_notify_benchmark, count_deliveries
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the notification path against a fake HipChat '
+            'server by replaying the recent events of a project.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--project', type='int',
+                    help='Id of the project whose events are replayed.'),
+        make_option('--tenants', type='int', default=10,
+                    help='Number of rooms subscribed to the project.'),
+        make_option('--rate', type='float', default=10.0,
+                    help='Events per second.'),
+        make_option('--duration', type='float', default=10.0,
+                    help='Seconds to generate events for.'),
+        make_option('--workers', type='int', default=4,
+                    help='Number of threads sending notifications.'),
+        make_option('--events', type='int', default=100,
+                    help='Number of distinct events to replay.'),
+        make_option('--latency', type='float', default=0.0),
+        make_option('--jitter', type='float', default=0.0),
+        make_option('--error-rate', type='float', default=0.0),
+        make_option('--rate-limit-rate', type='float', default=0.0),
+        make_option('--group-cooldown', type='int', default=0,
+                    help='Seconds a room is not notified about the same '
+                         'group again.  Disabled by default since events '
+                         'are replayed.'),
+        make_option('--check-budgets', action='store_true', default=False,
+                    help='Fail if any path goes over its query, Redis or '
+                         'HipChat request budget.'),
+        make_option('--force', action='store_true', default=False,
+                    help='Run even if real rooms are subscribed to the '
+                         'project.'),
+    )
+
+    def handle(self, **options):
+        if options['project'] is None:
+            raise CommandError('--project is required')
+        try:
+            project = Project.objects.get(pk=options['project'])
+        except Project.DoesNotExist:
+            raise CommandError('Unknown project')
+
+        if project.hipchat_tenant_set.exists() and not options['force']:
+            raise CommandError('The project has rooms subscribed which would '
+                               'be notified as well.  Pass --force to run '
+                               'anyway.')
+
+        events = load_events(project, options['events'])
+        if not events:
+            raise CommandError('The project has no events to replay')
+
+        fake = FakeHipChat(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            rate_limit_rate=options['rate_limit_rate'],
+        ).start()
+        tenants = create_tenants(fake, options['tenants'], [project])
+        try:
+            with budget_violations(options['check_budgets']) as violations:
+                result = run_notify_benchmark(
+                    events,
+                    rate=options['rate'],
+                    duration=options['duration'],
+                    workers=options['workers'],
+                    group_cooldown=options['group_cooldown'],
+                )
+        finally:
+            delete_tenants(tenants)
+            fake.stop()
+
+        done = len(result['latencies'])
+        self.stdout.write('Events: %d queued, %d sent, %d failed' % (
+            result['queued'], done, result['failures']))
+        self.stdout.write('Throughput: %.1f events/s, %.1f deliveries/s' % (
+            done / result['elapsed'],
+            count_deliveries(fake) / result['elapsed']))
+        self.stdout.write('Latency per event: %s' %
+                          format_latencies(result['latencies']))
+        self.stdout.write('HipChat requests:')
+        for (endpoint, status), count in sorted(fake.counts.items()):
+            self.stdout.write('  %-12s %d: %d' % (endpoint, status, count))
+
+        if options['check_budgets']:
+            lines = summarize_budget_violations(violations)
+            for line in lines:
+                self.stdout.write(line)
+            if lines:
+                raise CommandError('Budgets exceeded')
+            self.stdout.write('All paths stayed within their budgets')
@@ -0,0 +1,101 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from sentry.models import Project, User
+
+from sentry_hipchat_ac.bench import format_latencies, budget_violations, \
+     summarize_budget_violations
+from sentry_hipchat_ac.bench.fakehipchat import FakeHipChat
+from sentry_hipchat_ac.bench.notify import delete_tenants, load_events
+from sentry_hipchat_ac.bench.views import VIEWS, create_view_tenants, \
+     run_views_benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the add-on views with signed requests from '
+            'synthetic rooms subscribed to a project.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--project', type='int',
+                    help='Id of the project whose events are shown.'),
+        make_option('--user', type='int',
+                    help='Id of the Sentry user the rooms are authorized '
+                         'as.  Must have access to the project.'),
+        make_option('--views', default=','.join(VIEWS),
+                    help='Comma separated views to request.'),
+        make_option('--tenants', type='int', default=10),
+        make_option('--concurrency', type='int', default=4,
+                    help='Number of requests in flight.'),
+        make_option('--duration', type='float', default=10.0),
+        make_option('--events', type='int', default=100,
+                    help='Number of distinct events requested.'),
+        make_option('--links', type='int', default=1,
+                    help='Number of links per link message.'),
+        make_option('--latency', type='float', default=0.0,
+                    help='Latency of the fake HipChat server.'),
+        make_option('--check-budgets', action='store_true', default=False,
+                    help='Fail if any path goes over its query, Redis or '
+                         'HipChat request budget.'),
+        make_option('--force', action='store_true', default=False,
+                    help='Run even if real rooms are subscribed to the '
+                         'project.'),
+    )
+
+    def handle(self, **options):
+        if options['project'] is None or options['user'] is None:
+            raise CommandError('--project and --user are required')
+        try:
+            project = Project.objects.get(pk=options['project'])
+            user = User.objects.get(pk=options['user'])
+        except (Project.DoesNotExist, User.DoesNotExist):
+            raise CommandError('Unknown project or user')
+
+        views = [x.strip() for x in options['views'].split(',') if x.strip()]
+        unknown = set(views) - set(VIEWS)
+        if unknown:
+            raise CommandError('Unknown views: %s' % ', '.join(sorted(unknown)))
+
+        if project.hipchat_tenant_set.exists() and not options['force']:
+            raise CommandError('The project has rooms subscribed which would '
+                               'be notified as well.  Pass --force to run '
+                               'anyway.')
+
+        events = load_events(project, options['events'])
+        if not events:
+            raise CommandError('The project has no events to request')
+
+        fake = FakeHipChat(latency=options['latency']).start()
+        tenants = create_view_tenants(fake, options['tenants'], project,
+                                      user, events)
+        try:
+            with budget_violations(options['check_budgets']) as violations:
+                result = run_views_benchmark(
+                    tenants, events,
+                    views=views,
+                    concurrency=options['concurrency'],
+                    duration=options['duration'],
+                    links=options['links'],
+                )
+        finally:
+            delete_tenants(tenants)
+            fake.stop()
+
+        elapsed = result['elapsed']
+        for view in views:
+            view_result = result['views'][view]
+            self.stdout.write('%s: %.1f requests/s' % (
+                view, len(view_result['latencies']) / elapsed))
+            self.stdout.write('  Latency: %s' %
+                              format_latencies(view_result['latencies']))
+            self.stdout.write('  Status: %s' % ', '.join(
+                '%s: %d' % x
+                for x in sorted(view_result['statuses'].items())))
+
+        if options['check_budgets']:
+            lines = summarize_budget_violations(violations)
+            for line in lines:
+                self.stdout.write(line)
+            if lines:
+                raise CommandError('Budgets exceeded')
+            self.stdout.write('All paths stayed within their budgets')
@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from sentry_hipchat_ac.mentions import migrate_tenant_mentions
+from sentry_hipchat_ac.models import Tenant
+
+
+class Command(BaseCommand):
+    help = ('Rewrites the recent mentions of all HipChat tenants that are '
+            'still stored as JSON in the compact encoding.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help='Number of tenants to load per batch.'),
+    )
+
+    def handle(self, **options):
+        last_id = ''
+        tenants = migrated = 0
+        while True:
+            batch = list(Tenant.objects.filter(
+                id__gt=last_id).order_by('id')[:options['batch_size']])
+            if not batch:
+                break
+            for tenant in batch:
+                migrated += migrate_tenant_mentions(tenant)
+            tenants += len(batch)
+            last_id = batch[-1].id
+
+        self.stdout.write('Migrated %d mention(s) of %d room(s).' % (
+            migrated, tenants))
@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from sentry_hipchat_ac.tasks import refresh_all_room_info, \
+     ROOM_REFRESH_BATCH_SIZE, ROOM_REFRESH_CONCURRENCY
+
+
+class Command(BaseCommand):
+    help = 'Refreshes the room info of all HipChat tenants.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int',
+                    default=ROOM_REFRESH_BATCH_SIZE,
+                    help='Number of tenants to load per batch.'),
+        make_option('--concurrency', type='int',
+                    default=ROOM_REFRESH_CONCURRENCY,
+                    help='Number of requests to HipChat made at once.'),
+        make_option('--restart', action='store_true', default=False,
+                    help='Start over instead of continuing an interrupted '
+                         'run.'),
+    )
+
+    def handle(self, **options):
+        refreshed, failed = refresh_all_room_info(
+            batch_size=options['batch_size'],
+            concurrency=options['concurrency'],
+            resume=not options['restart'],
+        )
+        self.stdout.write('Refreshed %d room(s), %d failed.' % (
+            refreshed, failed))
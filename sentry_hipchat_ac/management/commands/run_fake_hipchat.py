@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from sentry_hipchat_ac.bench.fakehipchat import FakeHipChat
+
+
+class Command(BaseCommand):
+    help = 'Runs a fake HipChat API server for load testing.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host', default='127.0.0.1'),
+        make_option('--port', type='int', default=8765),
+        make_option('--latency', type='float', default=0.0,
+                    help='Base delay of every response in seconds.'),
+        make_option('--jitter', type='float', default=0.0,
+                    help='Maximum random delay added to every response.'),
+        make_option('--error-rate', type='float', default=0.0,
+                    help='Fraction of requests answered with a 500.'),
+        make_option('--rate-limit-rate', type='float', default=0.0,
+                    help='Fraction of requests answered with a 429.'),
+    )
+
+    def handle(self, **options):
+        fake = FakeHipChat(
+            host=options['host'],
+            port=options['port'],
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            rate_limit_rate=options['rate_limit_rate'],
+        )
+        self.stdout.write('Fake HipChat listening on %s' % fake.url)
+        try:
+            fake.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -1,5 +1,6 @@
 import json
 import time
+import struct
 
 from sentry.utils.dates import to_datetime, to_timestamp
 from sentry.models import Project, Group, Event
@@ -7,56 +8,220 @@ from sentry.models import Project, Group, Event
 from django.utils import timezone
 from django.conf import settings
 
+from . import stats
+from .utils import cluster
+
 
 MAX_RECENT = 15
 RECENT_HOURS = 24 * 30
 
+# For how many seconds a link that was unfurled in a room is remembered.
+# Posting the same link again within that window only refreshes the
+# mention instead of sending another card.
+UNFURL_TTL = getattr(settings, 'HIPCHAT_SENTRY_AC_UNFURL_TTL', 300)
+
+# Mentions keep a snapshot of what the sidebar shows.  Snapshots are
+# replaced whenever the group or event is mentioned again; if this is set,
+# snapshots older than that many seconds are also refreshed from the
+# database when the sidebar is shown.
+SNAPSHOT_MAX_AGE = getattr(settings, 'HIPCHAT_SENTRY_AC_SNAPSHOT_MAX_AGE', 0)
+
+# Longer titles and culprits are truncated in snapshots.
+SNAPSHOT_STRING_LENGTH = 200
+
+
+# Mention payloads are stored in a compact binary layout: a header with
+# the ids and the time of the mention, then the numbers of the snapshot
+# and its strings, each prefixed with its length.  Payloads written before
+# were JSON and are still read.
+PAYLOAD_VERSION = 1
+_header = struct.Struct('>BBQQQd')
+_snapshot_header = struct.Struct('>IQd')
+_string_length = struct.Struct('>H')
+_snapshot_strings = ('title', 'culprit', 'level', 'project_name',
+                     'project_link', 'link')
+
+_HAS_EVENT = 1
+_HAS_SNAPSHOT = 2
+_HAS_SNAPSHOT_EVENT = 4
+
+
+def encode_payload(item):
+    """Encodes the payload of a mention (``project``, ``group``,
+    ``event``, ``last_mentioned`` and optionally ``snapshot``).
+    """
+    snapshot = item.get('snapshot')
+    flags = 0
+    if item['event'] is not None:
+        flags |= _HAS_EVENT
+    if snapshot is not None:
+        flags |= _HAS_SNAPSHOT
+        if snapshot['event_id'] is not None:
+            flags |= _HAS_SNAPSHOT_EVENT
 
-# The Redis cluster manager (``clusters``) was added in Sentry 8.2 (GH-2714)
-# and replaces ``make_rb_cluster`` (which will be removed in a future version.)
-try:
-    from sentry.utils.redis import clusters
-    cluster = clusters.get('default')
-except ImportError:
-    from sentry.utils.redis import make_rb_cluster
-    cluster = make_rb_cluster(settings.SENTRY_REDIS_OPTIONS['hosts'])
+    rv = [_header.pack(PAYLOAD_VERSION, flags, item['project'],
+                       item['group'], item['event'] or 0,
+                       item['last_mentioned'])]
+    if snapshot is not None:
+        rv.append(_snapshot_header.pack(
+            min(snapshot['times_seen'] or 0, 0xffffffff),
+            snapshot['event_id'] or 0, snapshot['refreshed']))
+        for name in _snapshot_strings:
+            value = (snapshot[name] or u'').encode('utf-8')
+            rv.append(_string_length.pack(len(value)))
+            rv.append(value)
+    return ''.join(rv)
+
+
+def decode_payload(value):
+    """Decodes a payload written by `encode_payload` or a legacy JSON
+    payload.
+    """
+    if value[:1] == '{':
+        return json.loads(value)
+
+    version, flags, project, group, event, last_mentioned = \
+        _header.unpack_from(value)
+    if version != PAYLOAD_VERSION:
+        raise ValueError('Unknown mention payload version %d' % version)
+    rv = {
+        'project': project,
+        'group': group,
+        'event': event if flags & _HAS_EVENT else None,
+        'last_mentioned': last_mentioned,
+    }
+    if flags & _HAS_SNAPSHOT:
+        offset = _header.size
+        times_seen, event_id, refreshed = \
+            _snapshot_header.unpack_from(value, offset)
+        offset += _snapshot_header.size
+        snapshot = {
+            'times_seen': times_seen,
+            'event_id': event_id if flags & _HAS_SNAPSHOT_EVENT else None,
+            'refreshed': refreshed,
+        }
+        for name in _snapshot_strings:
+            length, = _string_length.unpack_from(value, offset)
+            offset += _string_length.size
+            snapshot[name] = value[offset:offset + length].decode('utf-8')
+            offset += length
+        rv['snapshot'] = snapshot
+    return rv
 
 
 def get_key(tenant):
     return 'sentry-hipchat-ac:%s:mentions' % tenant.id
 
 
-def get_recent_mentions(tenant):
-    client = cluster.get_routing_client()
-    key = get_key(tenant)
-    ids = [x for x in client.zrangebyscore(
-        key, time.time() - (RECENT_HOURS * 60), '+inf')][-MAX_RECENT:]
+def get_mention_id(group_id, event_id=None):
+    return '%s/%s' % (group_id, event_id if event_id is not None else '-')
 
-    with cluster.map() as map_client:
-        items = [map_client.get('%s:%s' % (key, id)) for id in ids]
-    items = [json.loads(x.value) for x in items if x.value is not None]
 
-    projects = items and dict((x.id, x) for x in Project.objects.filter(
+def make_snapshot(project, group, event=None):
+    """Returns what the sidebar shows about a mentioned group or event so
+    it can be rendered without touching the database.
+    """
+    target = event if event is not None else group
+    return {
+        'title': _shorten(target.error()),
+        'culprit': _shorten(target.culprit or ''),
+        'level': group.get_level_display(),
+        'project_name': project.name,
+        'project_link': project.get_absolute_url(),
+        'times_seen': group.times_seen,
+        'link': group.get_absolute_url(),
+        'event_id': event.id if event is not None else None,
+        'refreshed': time.time(),
+    }
+
+
+def _shorten(value):
+    if len(value) > SNAPSHOT_STRING_LENGTH:
+        return value[:SNAPSHOT_STRING_LENGTH - 3] + '...'
+    return value
+
+
+def _is_stale(item):
+    snapshot = item.get('snapshot')
+    if snapshot is None:
+        return True
+    return SNAPSHOT_MAX_AGE and \
+        snapshot['refreshed'] < time.time() - SNAPSHOT_MAX_AGE
+
+
+def _refresh_snapshots(key, items):
+    projects = dict((x.id, x) for x in Project.objects.filter(
         pk__in=[x['project'] for x in items],
-    )) or {}
-    groups = items and dict((x.id, x) for x in Group.objects.filter(
+    ))
+    groups = dict((x.id, x) for x in Group.objects.filter(
         pk__in=[x['group'] for x in items],
-    )) or {}
-    events = items and dict((x.id, x) for x in Event.objects.filter(
+    ))
+    events = dict((x.id, x) for x in Event.objects.filter(
         pk__in=[x['event'] for x in items if x['event'] is not None],
-    )) or {}
+    ))
 
+    refreshed = []
     for item in items:
-        item['project'] = projects.get(item['project'])
-        item['group'] = groups.get(item['group'])
-        item['event'] = events.get(item['event'])
-        if item['event'] is None and item['group'] is not None:
-            item['event'] = item['group'].get_latest_event()
-        item['last_mentioned'] = to_datetime(item['last_mentioned'])
+        project = projects.get(item['project'])
+        group = groups.get(item['group'])
+        if project is None or group is None:
+            continue
+        event = events.get(item['event'])
+        if event is None:
+            event = group.get_latest_event()
+            if event is not None:
+                events[event.id] = event
+        refreshed.append((item, project, group, event))
+
+    with stats.timer('nodestore'):
+        Event.objects.bind_nodes(events.values(), 'data')
+
+    expires = (RECENT_HOURS + 1) * 60 * 60
+    with stats.timer('redis', tags={'op': 'refresh_snapshots'},
+                     section=False):
+        with cluster.map() as client:
+            for item, project, group, event in refreshed:
+                item['snapshot'] = make_snapshot(project, group, event)
+                client.set('%s:%s' % (key, item['id']),
+                           encode_payload(item), ex=expires, xx=True)
+
+
+def get_recent_mentions(tenant):
+    """Returns the recent mentions of a tenant, oldest first, with the
+    snapshot of each flattened into it.  Only mentions recorded before
+    they had snapshots or with snapshots older than `SNAPSHOT_MAX_AGE`
+    need the database.
+    """
+    with stats.timer('redis', tags={'op': 'get_recent_mentions'},
+                     section=False):
+        client = cluster.get_routing_client()
+        key = get_key(tenant)
+        ids = [x for x in client.zrangebyscore(
+            key, time.time() - (RECENT_HOURS * 60), '+inf',
+            withscores=True)][-MAX_RECENT:]
+        stats.count_items(len(ids))
+
+        with cluster.map() as map_client:
+            items = [(id, map_client.get('%s:%s' % (key, id)), ts)
+                     for id, ts in ids]
+    items = [dict(decode_payload(x.value), id=id, last_mentioned=ts)
+             for id, x, ts in items if x.value is not None]
 
-    return items
+    stale = [x for x in items if _is_stale(x)]
+    if stale:
+        # Mentions of deleted groups are left stale and skipped.
+        _refresh_snapshots(key, stale)
+        items = [x for x in items if not _is_stale(x)]
+
+    rv = []
+    for item in items:
+        item.update(item.pop('snapshot'))
+        item['last_mentioned'] = to_datetime(item['last_mentioned'])
+        rv.append(item)
+    return rv
 
 
+@stats.timed('redis', section=False)
 def count_recent_mentions(tenant):
     client = cluster.get_routing_client()
     key = get_key(tenant)
@@ -64,33 +229,54 @@ def count_recent_mentions(tenant):
         key, time.time() - (RECENT_HOURS * 60), '+inf'))
 
 
+@stats.timed('redis', section=False)
 def clear_tenant_mentions(tenant):
     client = cluster.get_routing_client()
     key = get_key(tenant)
-    client.delete(key)
+    ids = client.zrange(key, 0, -1)
+    with cluster.map() as map_client:
+        map_client.delete(key)
+        for id in ids:
+            map_client.delete('%s:%s' % (key, id))
 
 
+@stats.timed('redis', section=False)
 def clear_project_mentions(tenant, projects):
     client = cluster.get_routing_client()
-    ids = [x.id for x in projects]
+    project_ids = set(x.id for x in projects)
     key = get_key(tenant)
-    items = client.zrange(key, 0, -1)
-    to_remove = []
-    for item in items:
-        if json.loads(item)['project'] in ids:
-            to_remove.append(item)
+    ids = client.zrange(key, 0, -1)
+    stats.count_items(len(ids))
+
+    with cluster.map() as map_client:
+        items = [(id, map_client.get('%s:%s' % (key, id))) for id in ids]
+    to_remove = [id for id, x in items if x.value is not None and
+                 decode_payload(x.value)['project'] in project_ids]
+
     if to_remove:
-        client.zrem(key, *to_remove)
+        with cluster.map() as map_client:
+            map_client.zrem(key, *to_remove)
+            for id in to_remove:
+                map_client.delete('%s:%s' % (key, id))
 
 
-def mention_event(project, group, tenant, event=None):
+@stats.timed('redis', section=False)
+def mention_event(project, group, tenant, event=None, snapshot=None):
+    """Records a mention of a group or event.  The `snapshot` of what the
+    sidebar shows is made with `make_snapshot` unless given, which can be
+    used to show the latest event of a mentioned group.  Returns the
+    number of recent mentions like `count_recent_mentions`.
+    """
     ts = to_timestamp(timezone.now())
-    id = '%s/%s' % (group.id, event.id if event is not None else '-')
-    item = json.dumps({
+    id = get_mention_id(group.id, event.id if event is not None else None)
+    if snapshot is None:
+        snapshot = make_snapshot(project, group, event)
+    item = encode_payload({
         'project': project.id,
         'group': group.id,
         'event': event.id if event is not None else None,
         'last_mentioned': ts,
+        'snapshot': snapshot,
     })
 
     expires = (RECENT_HOURS + 1) * 60 * 60
@@ -99,5 +285,85 @@ def mention_event(project, group, tenant, event=None):
         client.zadd(key, ts, id)
         client.expire(key, expires)
         client.setex('%s:%s' % (key, id), expires, item)
-        client.zremrangebyscore(key, '-inf', time.time() - (RECENT_HOURS * 60))
+        # Older mentions are skipped by the readers, only the size of the
+        # list has to be bounded here.
         client.zremrangebyrank(key, 0, -MAX_RECENT - 1)
+        count = client.zcount(key, time.time() - (RECENT_HOURS * 60), '+inf')
+    return min(MAX_RECENT, count.value)
+
+
+@stats.timed('redis', section=False)
+def touch_mentions(tenant, ids):
+    """Moves already recorded mentions to the top of the list without
+    touching their payload.  Ids that are no longer recorded are ignored.
+    """
+    ts = to_timestamp(timezone.now())
+    expires = (RECENT_HOURS + 1) * 60 * 60
+    key = get_key(tenant)
+
+    with cluster.map() as client:
+        found = [(id, client.expire('%s:%s' % (key, id), expires))
+                 for id in ids]
+    found = [id for id, rv in found if rv.value]
+    if not found:
+        return
+
+    with cluster.map() as client:
+        for id in found:
+            client.zadd(key, ts, id)
+        client.expire(key, expires)
+
+
+def _get_unfurl_key(tenant, room_id, id):
+    return '%s:unfurled:%s:%s' % (get_key(tenant), room_id, id)
+
+
+@stats.timed('redis', section=False)
+def claim_unfurls(tenant, room_id, ids):
+    """Remembers that the given mention ids were unfurled in a room and
+    returns the set of ids that were not already unfurled there within
+    the last `UNFURL_TTL` seconds.
+    """
+    with cluster.map() as client:
+        rv = [(id, client.set(_get_unfurl_key(tenant, room_id, id), '1',
+                              ex=UNFURL_TTL, nx=True)) for id in ids]
+    return set(id for id, result in rv if result.value)
+
+
+@stats.timed('redis', section=False)
+def release_unfurls(tenant, room_id, ids):
+    """Forgets about unfurls claimed with `claim_unfurls` that did not
+    end up being sent.
+    """
+    if not ids:
+        return
+    with cluster.map() as client:
+        for id in ids:
+            client.delete(_get_unfurl_key(tenant, room_id, id))
+
+
+@stats.timed('redis', section=False)
+def migrate_tenant_mentions(tenant):
+    """Rewrites the legacy JSON payloads of a tenant's mentions in the
+    current encoding, keeping their expiry.  Returns the number of
+    payloads rewritten.
+    """
+    client = cluster.get_routing_client()
+    key = get_key(tenant)
+    ids = client.zrange(key, 0, -1)
+
+    with cluster.map() as map_client:
+        items = [('%s:%s' % (key, id),
+                  map_client.get('%s:%s' % (key, id)),
+                  map_client.pttl('%s:%s' % (key, id))) for id in ids]
+    items = [(item_key, value.value, ttl.value)
+             for item_key, value, ttl in items
+             if value.value is not None and value.value[:1] == '{']
+    if not items:
+        return 0
+
+    with cluster.map() as map_client:
+        for item_key, value, ttl in items:
+            map_client.set(item_key, encode_payload(json.loads(value)),
+                           px=ttl > 0 and ttl or None, xx=True)
+    return len(items)
@@ -5,6 +5,7 @@ import logging
 import requests
 
 from django.db import models
+from django.db.models import Max
 from django.core.cache import cache
 from urlparse import urlparse, urljoin
 
@@ -14,7 +15,9 @@ from datetime import timedelta
 from sentry.models import Event, Group
 from sentry.db.models import BaseModel, BaseManager, FlexibleForeignKey
 
-from . import mentions
+from . import mentions, stats, delivery, routing
+from .cards import serialize_notification
+from .utils import cluster
 
 
 logger = logging.getLogger(__name__)
@@ -23,6 +26,18 @@ logger = logging.getLogger(__name__)
 MAX_RECENT = 15
 RECENT_HOURS = 12
 
+# Redis set with the ids of tenants whose credentials were rejected by
+# HipChat.  They are skipped when notifying and cleaned up by
+# `tasks.sweep_invalid_tenants`.
+_invalid_tenants_key = 'sentry-hipchat-ac:invalid-tenants'
+
+_invalid_sweep_scheduled_key = '%s:sweep-scheduled' % _invalid_tenants_key
+
+# How many seconds after a tenant was first marked invalid the sweeper runs,
+# and after how many seconds it checks again on tenants it could not check.
+INVALID_TENANT_SWEEP_DELAY = 60
+INVALID_TENANT_RETRY_DELAY = 5 * 60
+
 
 def base_url(url):
     result = urlparse(url)
@@ -46,9 +61,9 @@ class BadTenantError(HipChatException):
 
 class TenantManager(BaseManager):
 
-    def create(self, id, secret=None, homepage=None,
-               capabilities_url=None, room_id=None, token_url=None,
-               capdoc=None):
+    def _get_values(self, secret=None, homepage=None,
+                    capabilities_url=None, room_id=None, token_url=None,
+                    capdoc=None):
         if homepage is None and capdoc is not None:
             homepage = capdoc['links']['homepage']
         if token_url is None and capdoc is not None:
@@ -61,8 +76,7 @@ class TenantManager(BaseManager):
             api_base_url = capabilities_url.rsplit('/', 1)[0]
         installed_from = token_url and base_url(token_url) or None
 
-        return BaseManager.create(self,
-            id=id,
+        return dict(
             room_id=room_id,
             secret=secret,
             homepage=homepage,
@@ -72,6 +86,74 @@ class TenantManager(BaseManager):
             installed_from=installed_from,
         )
 
+    def create(self, id, **kwargs):
+        return BaseManager.create(self, id=id, **self._get_values(**kwargs))
+
+    def install(self, id, **kwargs):
+        """Creates a tenant or replaces an existing tenant of the same id
+        with a single write.  The subscriptions and mentions of a replaced
+        tenant are left to `detach` and `tasks.clear_tenant`, the room info
+        is left empty.  Returns
+        a tuple of the tenant's id and whether a tenant was replaced.
+        """
+        values = self._get_values(**kwargs)
+        values.update(
+            room_name=None,
+            room_owner_id=None,
+            room_owner_name=None,
+            auth_user=None,
+        )
+        _, created = self.create_or_update(id=id, values=values)
+        if not created:
+            # The new installation must not inherit the replaced one's
+            # deliveries or be deleted by a sweep that still has it
+            # marked as invalid.
+            tenant = self.model(id=id)
+            delivery.clear_delivery_log(tenant)
+            tenant.unmark_invalid()
+        return id, not created
+
+    def detach(self, id):
+        """Unlinks a replaced tenant from its organizations and projects
+        right away so that it gets no more notifications for them.  The
+        plugin options are left to `Tenant.clear`, which has to be passed
+        the returned project ids.
+        """
+        projects = self.model.projects.through.objects.filter(tenant=id)
+        project_ids = list(projects.values_list('project_id', flat=True))
+        projects.delete()
+        self.model.organizations.through.objects.filter(tenant=id).delete()
+        return project_ids
+
+    def get_invalid_ids(self):
+        client = cluster.get_routing_client()
+        return client.smembers(_invalid_tenants_key)
+
+    def unmark_invalid(self, ids):
+        client = cluster.get_routing_client()
+        client.srem(_invalid_tenants_key, *ids)
+
+    def schedule_invalid_sweep(self, countdown=INVALID_TENANT_SWEEP_DELAY):
+        """Schedules `tasks.sweep_invalid_tenants` unless it already is."""
+        client = cluster.get_routing_client()
+        if client.set(_invalid_sweep_scheduled_key, '1', ex=countdown,
+                      nx=True):
+            tasks.sweep_invalid_tenants.apply_async(countdown=countdown)
+
+    def clear_invalid_sweep(self):
+        """Called by the sweep when it starts so it can be scheduled
+        again.
+        """
+        client = cluster.get_routing_client()
+        client.delete(_invalid_sweep_scheduled_key)
+
+    def active(self):
+        """Returns all tenants that are not marked as invalid."""
+        invalid = self.get_invalid_ids()
+        if invalid:
+            return self.exclude(pk__in=invalid)
+        return self.all()
+
     def for_request(self, request, body=None):
         if body and 'oauth_client_id' in body:
             rv = Tenant.objects.get(pk=body['oauth_client_id'])
@@ -122,7 +204,8 @@ class Tenant(BaseModel):
     projects = models.ManyToManyField(
         'sentry.Project', related_name='hipchat_tenant_set')
 
-    def get_token(self, token_only=True, scopes=None):
+    def get_token(self, token_only=True, scopes=None, session=None,
+                  timeout=None):
         if scopes is None:
             scopes = ['send_notification', 'view_room']
 
@@ -133,15 +216,19 @@ class Tenant(BaseModel):
                 'grant_type': 'client_credentials',
                 'scope': ' '.join(scopes),
             }
-            resp = requests.post(self.token_url, data=data,
-                                 auth=HTTPBasicAuth(self.id, self.secret),
-                                 timeout=10)
+            resp = stats.http_request('token', self.installed_from, 'post',
+                                      self.token_url, session=session,
+                                      data=data,
+                                      auth=HTTPBasicAuth(self.id, self.secret),
+                                      timeout=timeout or delivery.get_timeout(
+                                          self.installed_from))
             if resp.status_code == 200:
                 return resp.json()
             elif resp.status_code == 401:
                 raise OauthClientInvalidError(self)
             else:
-                raise Exception('Invalid token: %s' % resp.text)
+                raise requests.HTTPError('Invalid token: %s' % resp.text,
+                                         response=resp)
 
         if token_only:
             token = cache.get(cache_key)
@@ -170,32 +257,58 @@ class Tenant(BaseModel):
         return jwt.encode(data, self.secret)
 
     def delete(self, *args, **kwargs):
-        for project in self.projects.all():
-            disable_plugin_for_tenant(project, self)
+        update_tenant_projects(self, remove=self.projects.all())
         mentions.clear_tenant_mentions(self)
+        delivery.clear_delivery_log(self)
+        self.unmark_invalid()
         BaseModel.delete(self, *args, **kwargs)
 
+    def mark_invalid(self):
+        """Marks the tenant as having invalid credentials.  This is cheap,
+        the actual cleanup is left to a background task.
+        """
+        client = cluster.get_routing_client()
+        if client.sadd(_invalid_tenants_key, self.id):
+            Tenant.objects.schedule_invalid_sweep()
+
+    def unmark_invalid(self):
+        Tenant.objects.unmark_invalid([self.id])
+
     def clear(self, commit=True):
         self.auth_user = None
         self.organizations.clear()
         mentions.clear_tenant_mentions(self)
-        for project in self.projects.all():
-            disable_plugin_for_tenant(project, self)
+        update_tenant_projects(self, remove=self.projects.all())
         if commit:
-            self.save()
-
-    def update_room_info(self, commit=True):
+            # Only what changed is written so that room info fetched
+            # concurrently is not overwritten.
+            self.save(update_fields=['auth_user'])
+
+    def get_room_info(self, session=None):
+        """Fetches the room info from HipChat.  Returns a dictionary with
+        the values for the room fields.
+        """
         headers = {
-            'Authorization': 'Bearer %s' % self.get_token(),
+            'Authorization': 'Bearer %s' % self.get_token(session=session),
             'Content-Type': 'application/json'
         }
-        room = requests.get(urljoin(self.api_base_url, 'room/%s') %
-                            self.room_id, headers=headers, timeout=5).json()
-        self.room_name = room['name']
-        self.room_owner_id = str(room['owner']['id'])
-        self.room_owner_name = room['owner']['name']
+        room = stats.http_request(
+            'room', self.installed_from, 'get',
+            urljoin(self.api_base_url, 'room/%s') % self.room_id,
+            session=session, headers=headers,
+            timeout=delivery.get_timeout(self.installed_from)).json()
+        return {
+            'room_name': room['name'],
+            'room_owner_id': str(room['owner']['id']),
+            'room_owner_name': room['owner']['name'],
+        }
+
+    def update_room_info(self, commit=True):
+        room_info = self.get_room_info()
+        for key, value in room_info.iteritems():
+            setattr(self, key, value)
         if commit:
-            self.save()
+            self.save(update_fields=list(room_info))
 
     def __repr__(self):
         return '<Tenant id=%r from=%r>' % (
@@ -225,20 +338,22 @@ class HipchatUser(object):
 
 class Context(object):
 
-    def __init__(self, tenant, sender, context, signed_request=None):
+    def __init__(self, tenant, sender, context, signed_request=None,
+                 deadline=None):
         self.tenant = tenant
         self.sender = sender
         self.context = context
         self.signed_request = signed_request
+        self.deadline = deadline
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
-        # If we get an invalid oauth client we better clean up the tenant
-        # and swallow the error.
+        # If we get an invalid oauth client we mark the tenant so it gets
+        # cleaned up and swallow the error.
         if isinstance(exc_value, OauthClientInvalidError):
-            self.tenant.delete()
+            self.tenant.mark_invalid()
             return True
 
     @staticmethod
@@ -271,20 +386,27 @@ class Context(object):
         )
 
     @staticmethod
-    def for_tenant(tenant):
-        """Creates a context just for a tenant."""
+    def for_tenant(tenant, deadline=None):
+        """Creates a context just for a tenant.  If a `deadline` timestamp
+        is given, notifications that cannot be sent before it are left to
+        a worker.
+        """
         return Context(
             tenant=tenant,
             sender=None,
             context={},
+            deadline=deadline,
         )
 
     @property
     def tenant_token(self):
         """The cached token of the current tenant."""
+        return self.get_tenant_token()
+
+    def get_tenant_token(self, timeout=None):
         rv = getattr(self, '_tenant_token', None)
         if rv is None:
-            rv = self._tenant_token = self.tenant.get_token()
+            rv = self._tenant_token = self.tenant.get_token(timeout=timeout)
         return rv
 
     @property
@@ -292,27 +414,116 @@ class Context(object):
         """The most appropriate room for this context."""
         return self.context.get('room_id', self.tenant.room_id)
 
-    def post(self, url, data):
-        resp = requests.post(urljoin(self.tenant.api_base_url, url), headers={
-            'Authorization': 'Bearer %s' % self.tenant_token,
-            'Content-Type': 'application/json'
-        }, data=json.dumps(data), timeout=10)
+    def post(self, url, data, endpoint='notification', lane=None):
+        """Posts to the HipChat API.  `data` is either a JSON serializable
+        object or an already serialized request body.  `lane` is one of the
+        priority lanes in `delivery` and defaults to the glance lane for
+        glances and the system lane otherwise.
+
+        Notifications that cannot be sent right now because the circuit
+        breaker of the tenant's HipChat server is open, the deadline of the
+        context has passed, their lane is full or the server cannot be
+        reached are deferred, other requests are dropped; `None` is
+        returned then.
+        """
+        if not isinstance(data, basestring):
+            data = json.dumps(data)
+        if lane is None:
+            lane = endpoint == 'glance' and delivery.LANE_GLANCE \
+                or delivery.LANE_SYSTEM
+
+        server = self.tenant.installed_from
+        timeout = delivery.get_timeout(server, self.deadline)
+        if timeout is None:
+            self._defer(url, data, endpoint, lane, countdown=0)
+            return None
+        if not delivery.acquire_lane(server, lane):
+            self._defer(url, data, endpoint, lane,
+                        countdown=delivery.RATE_WINDOW)
+            return None
+
+        try:
+            # The breaker is checked first so that requests it holds back
+            # do not use up the rate budget of the server.
+            breaker = delivery.CircuitBreaker(server)
+            held_back = delivery.admit(breaker, lane)
+            if held_back == 'rate':
+                self._defer(url, data, endpoint, lane,
+                            countdown=delivery.RATE_WINDOW)
+                return None
+            elif held_back is not None:
+                self._defer(url, data, endpoint, lane,
+                            countdown=delivery.BREAKER_RESET_TIMEOUT + 1)
+                return None
+            count_rate = lane == delivery.LANE_ALERT
+
+            start = time.time()
+            try:
+                token = self.get_tenant_token(timeout=timeout)
+                resp = stats.http_request(
+                    endpoint, server, 'post',
+                    urljoin(self.tenant.api_base_url, url), headers={
+                        'Authorization': 'Bearer %s' % token,
+                        'Content-Type': 'application/json'
+                    }, data=data, timeout=timeout)
+            except requests.RequestException as e:
+                delivery.log_delivery(
+                    self.tenant, endpoint, lane,
+                    isinstance(e, requests.Timeout) and 'timeout' or 'error',
+                    len(data), time.time() - start, count_rate=count_rate)
+                # Client errors from the token endpoint are not the
+                # server's fault and would fail again.
+                if e.response is not None and e.response.status_code < 500:
+                    raise
+                logger.warning('Request to "%s" failed', url, exc_info=True)
+                self._record_failure(breaker)
+                self._defer(url, data, endpoint, lane,
+                            countdown=delivery.BREAKER_RESET_TIMEOUT + 1)
+                return None
+        finally:
+            delivery.release_lane(lane)
+
+        delivery.log_delivery(self.tenant, endpoint, lane, resp.status_code,
+                              len(data), time.time() - start,
+                              count_rate=count_rate)
+        if resp.status_code >= 500:
+            self._record_failure(breaker)
+        elif breaker.record_success():
+            tasks.schedule_deferred_flush(server)
         if not resp.ok:
             logger.warning('Request to "%s" failed:\n%s',
                            url, resp.text)
         return resp
 
+    def _defer(self, url, data, endpoint, lane, countdown):
+        if endpoint != 'notification':
+            delivery.log_delivery(self.tenant, endpoint, lane, 'dropped',
+                                  len(data))
+            return
+        delivery.log_delivery(self.tenant, endpoint, lane, 'deferred',
+                              len(data))
+        delivery.defer(self.tenant, url, data, endpoint, lane)
+        tasks.schedule_deferred_flush(self.tenant.installed_from, countdown)
+
+    def _record_failure(self, breaker):
+        if breaker.record_failure():
+            tasks.schedule_deferred_flush(
+                self.tenant.installed_from,
+                countdown=delivery.BREAKER_RESET_TIMEOUT + 1)
+
     def send_notification(self, message, color='yellow', notify=False,
-                          format='html', card=None):
-        data = {'message': message, 'format': format, 'notify': notify}
-        if color is not None:
-            data['color'] = color
-        if card is not None:
-            data['card'] = card
-        self.post('room/%s/notification' % self.room_id, data)
-
-    def get_recent_events_glance(self):
-        count = mentions.count_recent_mentions(self.tenant)
+                          format='html', card=None, lane=None):
+        self.send_serialized_notification(serialize_notification(
+            message, color=color, notify=notify, format=format, card=card),
+            lane=lane)
+
+    def send_serialized_notification(self, body, lane=None):
+        """Sends a notification serialized with `serialize_notification`."""
+        self.post('room/%s/notification' % self.room_id, body, lane=lane)
+
+    def get_recent_events_glance(self, count=None):
+        if count is None:
+            count = mentions.count_recent_mentions(self.tenant)
         return {
             'label': {
                 'type': 'html',
@@ -321,52 +532,125 @@ class Context(object):
             },
         }
 
-    def push_recent_events_glance(self):
+    def push_recent_events_glance(self, count=None):
+        """Pushes the glance with the number of recent mentions, which is
+        looked up unless `count` is given.
+        """
         self.post('addon/ui/room/%s' % self.room_id, {
             'glance': [{
-                'content': self.get_recent_events_glance(),
+                'content': self.get_recent_events_glance(count),
                 'key': 'sentry-recent-events-glance',
             }]
-        })
+        }, endpoint='glance')
 
     def _ensure_and_bind_event(self, event):
         rv = self.tenant.projects.filter(pk=event.project.id).first()
         if rv is not None:
-            Event.objects.bind_nodes([event], 'data')
+            with stats.timer('nodestore'):
+                Event.objects.bind_nodes([event], 'data')
             return event
 
     def get_event(self, event_id):
+        rv = self._get_event(event_id)
+        if rv is None and routing.get_read_db() is not None:
+            # The replica may not have the event yet.
+            stats.incr('replica.fallback', tags={'reason': 'miss'})
+            with routing.primary():
+                rv = self._get_event(event_id)
+        return rv
+
+    def _get_event(self, event_id):
         try:
-            event = Event.objects.get(pk=int(event_id))
+            event = Event.objects.using(routing.get_read_db()).get(
+                pk=int(event_id))
         except (ValueError, Event.DoesNotExist):
             return None
         return self._ensure_and_bind_event(event)
 
     def get_event_from_url_params(self, group_id, event_id=None, slug_vars=None):
-        if event_id is not None:
-            try:
-                event = Event.objects.get(pk=int(event_id))
-            except (ValueError, Event.DoesNotExist):
-                return None
-            group = event.group
-            if str(group.id) != group_id:
-                return None
-        else:
-            try:
-                group = Group.objects.get(pk=int(group_id))
-            except (ValueError, Group.DoesNotExist):
-                return None
-            event = group.get_latest_event()
-        event = self._ensure_and_bind_event(event)
-        if event is None:
-            return None
-
-        if slug_vars is not None:
-            if slug_vars['org_slug'] != group.organization.slug or \
-               slug_vars['proj_slug'] != group.project.slug:
-                return None
-
-        return event
+        if slug_vars is None:
+            slug_vars = {}
+        rv = self.get_events_from_url_params([{
+            'group': group_id,
+            'event': event_id,
+            'org': slug_vars.get('org_slug'),
+            'proj': slug_vars.get('proj_slug'),
+        }])
+        if rv:
+            return rv[0][1]
+
+    def get_events_from_url_params(self, links):
+        """Resolves a list of link parameters (``group``, ``event`` and
+        optionally ``org`` and ``proj`` slugs) to events.  This issues the
+        same number of queries no matter how many links are passed.
+        Links that cannot be resolved or that point to a project the
+        tenant is not subscribed to are skipped.  Returns a list of
+        ``(params, event)`` tuples in the order of the links.
+        """
+        rv = self._get_events_from_url_params(links)
+        if len(rv) < len(links) and routing.get_read_db() is not None:
+            # The replica may not have all of the events yet.
+            stats.incr('replica.fallback', tags={'reason': 'miss'})
+            with routing.primary():
+                rv = self._get_events_from_url_params(links)
+        return rv
 
+    def _get_events_from_url_params(self, links):
+        parsed = []
+        for params in links:
+            try:
+                group_id = int(params['group'])
+                event_id = params.get('event')
+                if event_id is not None:
+                    event_id = int(event_id)
+            except ValueError:
+                continue
+            parsed.append((params, group_id, event_id))
+        if not parsed:
+            return []
+
+        # For links without an event we go with the most recently stored
+        # event of the group.
+        db = routing.get_read_db()
+        latest_event_ids = dict(Event.objects.using(db).filter(
+            group_id__in=set(x[1] for x in parsed if x[2] is None),
+        ).values_list('group_id').annotate(latest=Max('id')))
+
+        event_ids = set(x[2] for x in parsed if x[2] is not None)
+        events = dict((x.id, x) for x in Event.objects.using(db).filter(
+            pk__in=event_ids | set(latest_event_ids.itervalues())))
+        groups = dict((x.id, x) for x in Group.objects.using(db).filter(
+            pk__in=set(x[1] for x in parsed) |
+            set(x.group_id for x in events.itervalues()),
+        ).select_related('project', 'project__organization'))
+        allowed_projects = set(self.tenant.projects.filter(
+            pk__in=set(x.project_id for x in groups.itervalues()),
+        ).values_list('id', flat=True))
+
+        rv = []
+        for params, group_id, event_id in parsed:
+            if event_id is None:
+                event_id = latest_event_ids.get(group_id)
+            event = events.get(event_id)
+            if event is None or event.group_id != group_id:
+                continue
+            group = groups.get(group_id)
+            if group is None or group.project_id not in allowed_projects:
+                continue
+            if params.get('org') is not None and \
+               params['org'] != group.organization.slug:
+                continue
+            if params.get('proj') is not None and \
+               params['proj'] != group.project.slug:
+                continue
+            event.group = group
+            event.project = group.project
+            rv.append((params, event))
+
+        if rv:
+            with stats.timer('nodestore'):
+                Event.objects.bind_nodes([x[1] for x in rv], 'data')
+        return rv
 
-from .plugin import disable_plugin_for_tenant
+from .plugin import update_tenant_projects
+from . import tasks
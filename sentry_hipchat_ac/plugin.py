@@ -1,18 +1,27 @@
+import time
 import logging
 import sentry_hipchat_ac
 from urllib import quote as url_quote
 from urlparse import urlparse
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
 from django.template.loader import render_to_string
 from django.template.context import RequestContext
 
+from sentry.models import Project, ProjectOption
 from sentry.plugins import plugins
 from sentry.plugins.bases.notify import NotifyPlugin
 from sentry.utils.http import absolute_uri
 from django.core.urlresolvers import reverse
 
-from .cards import make_event_notification, make_activity_notification
+from . import delivery, stats
+from .cards import ACTIVITY_TYPES, make_event_notification, \
+     make_activity_notification, serialize_notification
+
+
+logger = logging.getLogger(__name__)
 
 
 ADDON_HOST_IDENT = urlparse(settings.SENTRY_URL_PREFIX).hostname
@@ -29,41 +38,110 @@ COLORS = {
 }
 
 
-def enable_plugin_for_tenant(project, tenant):
-    rv = False
+def update_tenant_projects(tenant, add=(), remove=(), refresh=()):
+    """Subscribes a tenant to the projects in `add` and unsubscribes it
+    from the projects in `remove` in one go.  Only projects whose
+    subscription actually changes are written to, plus the projects in
+    `refresh` whose plugin options are brought up to date regardless.
+    Returns a tuple with the lists of projects that were added and
+    removed.
+    """
     plugin = plugins.get('hipchat-ac')
+    through = Tenant.projects.through
 
-    # Make sure the plugin itself is enabled.
-    plugin.enable(project)
+    add = dict((x.id, x) for x in add)
+    remove = dict((x.id, x) for x in remove if x.id not in add)
+    refresh = dict((x.id, x) for x in refresh
+                   if x.id not in add and x.id not in remove)
+    if not add and not remove and not refresh:
+        return [], []
 
-    # Add our tenant to the plugin.
-    active = set(plugin.get_option('tenants', project) or ())
-    if tenant.id not in active:
-        active.add(tenant.id)
-        tenant.projects.add(project)
-        rv = True
-    plugin.set_option('tenants', sorted(active), project)
+    with transaction.atomic(using=router.db_for_write(through)):
+        # Lock the affected projects so that concurrent saves from other
+        # rooms serialize here instead of overwriting each other's
+        # tenant lists.  Rows are locked in id order so that two saves
+        # touching the same projects cannot deadlock.
+        list(Project.objects.select_for_update().filter(
+            pk__in=list(add) + list(remove) + list(refresh)
+        ).order_by('id').values_list('id', flat=True))
 
-    return rv
+        current = set(through.objects.filter(
+            tenant=tenant,
+            project__in=list(add) + list(remove),
+        ).values_list('project_id', flat=True))
+        added = [x for id, x in add.iteritems() if id not in current]
+        removed = [x for id, x in remove.iteritems() if id in current]
 
+        if added:
+            through.objects.bulk_create([
+                through(tenant=tenant, project=x) for x in added])
+        if removed:
+            through.objects.filter(
+                tenant=tenant,
+                project__in=[x.id for x in removed],
+            ).delete()
 
-def disable_plugin_for_tenant(project, tenant):
-    rv = False
-    plugin = plugins.get('hipchat-ac')
+        # The relationship table is the source of truth, the plugin
+        # options are rebuilt from it for every project that changed.
+        changed = added + removed + refresh.values()
+        active = {}
+        for project_id, tenant_id in through.objects.filter(
+                project__in=[x.id for x in changed]) \
+                .values_list('project_id', 'tenant_id'):
+            active.setdefault(project_id, set()).add(tenant_id)
+        _write_project_options(plugin, changed, active, added)
+
+    # The options were written without the signals that keep their cache
+    # fresh, so the cached options are dropped now that they are
+    # committed.
+    cache.delete_many([ProjectOption.objects._make_key(x.id)
+                       for x in changed])
+    ProjectOption.objects.clear_local_cache()
+    return added, removed
 
-    # Remove our tenant to the plugin.
-    active = set(plugin.get_option('tenants', project) or ())
-    if tenant.id in active:
-        tenant.projects.remove(project)
-        active.discard(tenant.id)
-        rv = True
-    plugin.set_option('tenants', sorted(active), project)
+
+def _write_project_options(plugin, changed, active, added):
+    """Writes the ``tenants`` option of the changed projects and enables
+    or disables the plugin for them in bulk.  The plugin is only enabled
+    for newly added projects that are not enabled yet and disabled for
+    projects left without tenants.
+    """
+    tenants_key = '%s:tenants' % plugin.get_conf_key()
+    enabled_key = '%s:enabled' % plugin.get_conf_key()
+    project_ids = [x.id for x in changed]
+    enabled = set(x.project_id for x in ProjectOption.objects.filter(
+        project__in=project_ids, key=enabled_key) if x.value)
 
     # If the last tenant is gone, we disable the entire plugin.
-    if not active:
-        plugin.disable(project)
+    toggled = dict((x.id, True) for x in added
+                   if x.id in active and x.id not in enabled)
+    toggled.update((x.id, False) for x in changed
+                   if x.id not in active and x.id in enabled)
+
+    # Deleted without signals, which would reload the option cache per
+    # row.  The caller drops the cache once the transaction commits.
+    using = router.db_for_write(ProjectOption)
+    ProjectOption.objects.filter(
+        project__in=project_ids, key=tenants_key)._raw_delete(using)
+    if toggled:
+        ProjectOption.objects.filter(
+            project__in=list(toggled), key=enabled_key)._raw_delete(using)
+    ProjectOption.objects.bulk_create([
+        ProjectOption(project=x, key=tenants_key,
+                      value=sorted(active.get(x.id) or ()))
+        for x in changed
+    ] + [
+        ProjectOption(project_id=project_id, key=enabled_key, value=value)
+        for project_id, value in toggled.iteritems()
+    ])
+
+
+def enable_plugin_for_tenant(project, tenant):
+    return bool(update_tenant_projects(tenant, add=[project])[0])
+
 
-    return rv
+def disable_plugin_for_tenant(project, tenant):
+    return bool(update_tenant_projects(tenant, remove=[project])[1])
 
 
 class HipchatNotifier(NotifyPlugin):
@@ -80,7 +158,7 @@ class HipchatNotifier(NotifyPlugin):
     title = 'HipChat with Atlassian Connect'
     conf_title = title
     conf_key = 'hipchat-ac'
-    timeout = getattr(settings, 'SENTRY_HIPCHAT_TIMEOUT', 3)
+    timeout = delivery.MAX_TIMEOUT
 
     def is_configured(self, project):
         return bool(self.get_option('tenants', project))
@@ -117,31 +195,97 @@ class HipchatNotifier(NotifyPlugin):
 
         if project is not None and was_enabled:
             for tenant in Tenant.objects.filter(projects__in=[project]):
-                disable_plugin_for_tenant(project, tenant)
+                update_tenant_projects(tenant, remove=[project])
 
+    @stats.timed_path('notify_users')
     def notify_users(self, group, event, fail_silently=False, **kwargs):
-        tenants = Tenant.objects.filter(projects=event.project)
+        tenants = list(Tenant.objects.active().filter(
+            projects=event.project))
+        if not tenants:
+            return
+
+        deadline = time.time() + delivery.NOTIFY_DEADLINE
+
+        # Rooms that were recently notified about the group are skipped.
+        # The others share one rendered and serialized notification per
+        # number of skipped occurrences to report, usually only one.
+        # Skipped rooms still cost Redis commands so they count as well.
+        stats.count_items(len(tenants))
+        allowed = cooldown.check_cooldowns(tenants, group)
+        bodies = {}
+        snapshot = allowed and mentions.make_snapshot(
+            event.project, group, event)
         for tenant in tenants:
-            with Context.for_tenant(tenant) as ctx:
-                ctx.send_notification(**make_event_notification(
-                    group, event, tenant))
-
-                mentions.mention_event(
-                    project=event.project,
-                    group=group,
-                    tenant=tenant,
-                    event=event,
-                )
-                ctx.push_recent_events_glance()
+            if tenant.id not in allowed:
+                continue
+            suppressed = allowed[tenant.id]
+            body = bodies.get(suppressed)
+            if body is None:
+                body = bodies[suppressed] = serialize_notification(
+                    **make_event_notification(
+                        group, event, suppressed=suppressed))
+
+            # A failing room must not keep the others from being notified.
+            try:
+                with Context.for_tenant(tenant, deadline=deadline) as ctx:
+                    ctx.send_serialized_notification(
+                        body, lane=delivery.LANE_ALERT)
+
+                    count = mentions.mention_event(
+                        project=event.project,
+                        group=group,
+                        tenant=tenant,
+                        event=event,
+                        snapshot=snapshot,
+                    )
+                    ctx.push_recent_events_glance(count)
+            except Exception:
+                logger.warning('Could not notify %r', tenant, exc_info=True)
 
+    @stats.timed_path('notify_about_activity')
     def notify_about_activity(self, activity):
-        tenants = Tenant.objects.filter(projects=activity.project)
-        for tenant in tenants:
-            with Context.for_tenant(tenant) as ctx:
-                n = make_activity_notification(activity, tenant)
-                if n is not None:
-                    ctx.send_notification(**n)
+        if activity.type not in ACTIVITY_TYPES:
+            return
+        if not Tenant.objects.active().filter(
+                projects=activity.project).exists():
+            return
+
+        # Activities come in bursts during triage so they are collected
+        # per group and summarized in one notification.
+        if coalesce.ACTIVITY_WINDOW:
+            if coalesce.buffer_activity(activity):
+                tasks.flush_activities.apply_async(
+                    kwargs={'group_id': activity.group_id},
+                    countdown=coalesce.ACTIVITY_WINDOW)
+            return
+
+        send_activity_notification(activity.project,
+                                   make_activity_notification(activity))
+
+
+def send_activity_notification(project, n):
+    """Sends a notification about activities to all rooms subscribed to
+    the project.
+    """
+    if n is None:
+        return
+    tenants = list(Tenant.objects.active().filter(projects=project))
+    if not tenants:
+        return
+    stats.count_items(len(tenants))
+
+    # The notification does not depend on the tenant so it's only
+    # serialized once.
+    body = serialize_notification(**n)
+    deadline = time.time() + delivery.NOTIFY_DEADLINE
+    for tenant in tenants:
+        try:
+            with Context.for_tenant(tenant, deadline=deadline) as ctx:
+                ctx.send_serialized_notification(
+                    body, lane=delivery.LANE_ACTIVITY)
+        except Exception:
+            logger.warning('Could not notify %r', tenant, exc_info=True)
 
 
 from .models import Tenant, Context
-from . import mentions
+from . import mentions, cooldown, coalesce, tasks
@@ -0,0 +1,135 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from functools import update_wrapper
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+
+from . import stats
+
+
+logger = logging.getLogger(__name__)
+
+
+# The database alias that read-only views read Sentry's data from, usually
+# a replica.  Add `ReadReplicaRouter` to ``DATABASE_ROUTERS`` to route all
+# of their queries; without it only the event lookups of `Context` use it.
+READ_DB = getattr(settings, 'HIPCHAT_SENTRY_AC_READ_DB', None)
+
+# If a PostgreSQL replica is that many seconds behind the primary the
+# primary is used instead.  This is checked every few seconds per process.
+READ_DB_MAX_LAG = getattr(settings, 'HIPCHAT_SENTRY_AC_READ_DB_MAX_LAG', 10)
+LAG_CHECK_INTERVAL = 5
+
+_local = threading.local()
+_lag = {'checked': 0.0, 'lagging': False}
+
+
+def _get_replica_lag():
+    conn = connections[READ_DB]
+    if conn.vendor != 'postgresql':
+        return 0.0
+    # The time since the last replayed transaction is only lag if the
+    # replica has received WAL it did not replay yet.  Otherwise it is
+    # caught up and the primary merely had no writes.
+    cursor = conn.cursor()
+    try:
+        if conn.pg_version >= 100000:
+            received, replayed = ('pg_last_wal_receive_lsn',
+                                  'pg_last_wal_replay_lsn')
+        else:
+            received, replayed = ('pg_last_xlog_receive_location',
+                                  'pg_last_xlog_replay_location')
+        cursor.execute('SELECT CASE WHEN %s() = %s() THEN 0 '
+                       'ELSE EXTRACT(EPOCH FROM now() - '
+                       'pg_last_xact_replay_timestamp()) END' % (
+                           received, replayed))
+        return cursor.fetchone()[0] or 0.0
+    finally:
+        cursor.close()
+
+
+def _is_lagging():
+    now = time.time()
+    if _lag['checked'] + LAG_CHECK_INTERVAL < now:
+        _lag['checked'] = now
+        try:
+            _lag['lagging'] = _get_replica_lag() > READ_DB_MAX_LAG
+        except DatabaseError:
+            logger.warning('Could not check the lag of %r', READ_DB,
+                           exc_info=True)
+            _lag['lagging'] = True
+        if _lag['lagging']:
+            stats.incr('replica.fallback', tags={'reason': 'lag'})
+    return _lag['lagging']
+
+
+def get_read_db():
+    """Returns the database alias reads should go to right now or `None`
+    for the default.
+    """
+    if READ_DB is None or not getattr(_local, 'read_only', 0) or \
+       getattr(_local, 'primary', 0) or _is_lagging():
+        return None
+    return READ_DB
+
+
+@contextmanager
+def read_only():
+    """Sends reads in the block to `READ_DB` if it is configured."""
+    _local.read_only = getattr(_local, 'read_only', 0) + 1
+    try:
+        yield
+    finally:
+        _local.read_only -= 1
+
+
+@contextmanager
+def primary():
+    """Sends reads in the block to the default database again, for
+    instance to retry a lookup that missed on the replica.
+    """
+    _local.primary = getattr(_local, 'primary', 0) + 1
+    try:
+        yield
+    finally:
+        _local.primary -= 1
+
+
+def read_only_view(f):
+    """Decorator for views that only read Sentry's data on ``GET``."""
+    def new_f(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return f(request, *args, **kwargs)
+        with read_only():
+            return f(request, *args, **kwargs)
+    return update_wrapper(new_f, f)
+
+
+class ReadReplicaRouter(object):
+    """Routes reads of Sentry's models inside `read_only` blocks to
+    `READ_DB`.  The add-on's own models always use the default database so
+    that fresh installations and subscriptions are seen right away.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'sentry':
+            return None
+        instance = hints.get('instance')
+        if instance is not None and \
+           instance._meta.app_label != 'sentry':
+            return None
+        return get_read_db()
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_syncdb(self, db, model):
+        if READ_DB is not None and db == READ_DB:
+            return False
+        return None
@@ -0,0 +1,315 @@
+import time
+import logging
+import requests
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import update_wrapper
+from urlparse import urlparse
+
+from django.conf import settings
+from django.db import connections
+
+from sentry.utils import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+# If enabled, views record where their time is spent and report it in a
+# ``Server-Timing`` header and a log line.
+SERVER_TIMING = getattr(settings, 'HIPCHAT_SENTRY_AC_SERVER_TIMING', False)
+
+# How many of the most recent request durations are kept per HipChat
+# server to compute latency percentiles from.
+LATENCY_WINDOW = 200
+
+# Upper bounds for the number of database queries, Redis commands and
+# HipChat requests of the views, webhook handlers and notification paths.
+# Tuples are a fixed part and a part per item the path handles (see
+# `count_items`).  A request to HipChat costs six Redis commands in two
+# round trips: the breaker and rate check before and the delivery log
+# after it.  Paths that go over their budget are logged; the tests and
+# load tests collect them with `collect_budget_violations`.
+BUDGETS = {
+    'recent_events_glance': {'db': 2, 'redis': 1, 'hipchat': 0},
+    # Per mention: the payload and, if stale, its refreshed snapshot.
+    'recent_events': {'db': 2, 'redis': (1, 2), 'hipchat': 0},
+    'event_details': {'db': 10, 'redis': 0, 'hipchat': 0},
+    'assign_event': {'db': 12, 'redis': 0, 'hipchat': 0},
+    # Saving the projects sends a message and a glance; per mention of a
+    # removed project its payload is read and deleted.
+    'configure': {'db': 20, 'redis': (15, 2), 'hipchat': 0},
+    'on_link_message': {'db': 2, 'redis': 0, 'hipchat': 0},
+    # Per link: the unfurl claim and recording the mention.
+    'on_link_message.handler': {'db': 8, 'redis': (13, 6), 'hipchat': 3},
+    # Per room: the cooldown, the alert, the mention and the glance.
+    'notify_users': {'db': (6, 0), 'redis': (1, 20), 'hipchat': (0, 3)},
+    'notify_about_activity': {'db': (10, 0), 'redis': (4, 6),
+                              'hipchat': (0, 3)},
+    'flush_activities': {'db': (10, 0), 'redis': (4, 6), 'hipchat': (0, 3)},
+}
+
+_local = threading.local()
+_budget_listeners = []
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+
+class RequestTimings(object):
+    """Collects the time spent per section (``auth``, ``db``, ``redis``,
+    ``nodestore``, ``template``, ``hipchat``) while handling a request.
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.sections = {}
+        self.start = time.time()
+        self.items = 0
+        self._db_cursors = {}
+
+    def add(self, section, duration, count=1):
+        rv = self.sections.setdefault(section, [0, 0.0])
+        rv[0] += count
+        rv[1] += duration
+
+    def _start_db(self):
+        for conn in connections.all():
+            self._db_cursors[conn.alias] = (
+                conn.use_debug_cursor, len(conn.queries))
+            conn.use_debug_cursor = True
+
+    def _stop_db(self):
+        for conn in connections.all():
+            if conn.alias not in self._db_cursors:
+                continue
+            use_debug_cursor, offset = self._db_cursors[conn.alias]
+            queries = conn.queries[offset:]
+            self.add('db', sum(float(x['time']) for x in queries),
+                     count=len(queries))
+            conn.use_debug_cursor = use_debug_cursor
+            if not settings.DEBUG:
+                del conn.queries[offset:]
+        self._db_cursors = {}
+
+    def get_header(self):
+        rv = []
+        for section, (count, duration) in sorted(self.sections.items()):
+            rv.append('%s;dur=%.1f;desc="%d call%s"' % (
+                section, duration * 1000, count, count != 1 and 's' or ''))
+        rv.append('total;dur=%.1f' % ((time.time() - self.start) * 1000))
+        return ', '.join(rv)
+
+    def finish(self, resp):
+        self._stop_db()
+        resp['Server-Timing'] = self.get_header()
+        extra = {
+            'view': self.view,
+            'duration': time.time() - self.start,
+        }
+        for section, (count, duration) in self.sections.iteritems():
+            extra['%s_count' % section] = count
+            extra['%s_duration' % section] = duration
+        logger.info('view.timings', extra=extra)
+        return resp
+
+    def check_budget(self):
+        """Returns the sections that went over the budget of the view."""
+        rv = []
+        budget = BUDGETS.get(self.view) or {}
+        for section, limit in sorted(budget.items()):
+            if isinstance(limit, tuple):
+                limit = limit[0] + limit[1] * self.items
+            count = self.sections.get(section, (0, 0.0))[0]
+            if count > limit:
+                rv.append({
+                    'path': self.view,
+                    'section': section,
+                    'count': count,
+                    'limit': limit,
+                })
+        return rv
+
+    def _report_budget(self):
+        for violation in self.check_budget():
+            logger.warning('budget.exceeded', extra=violation)
+            incr('budget.exceeded', tags={
+                'path': violation['path'],
+                'section': violation['section'],
+            })
+            for listener in _budget_listeners:
+                listener.append(violation)
+
+
+class _NoopTimings(object):
+
+    def finish(self, resp):
+        return resp
+
+
+@contextmanager
+def request_timings(view):
+    """Records the timings of a view if `SERVER_TIMING` is enabled or
+    budget violations are collected.  The response of a view has to be
+    passed through ``finish`` of the yielded object.
+    """
+    if not SERVER_TIMING and not _budget_listeners:
+        yield _NoopTimings()
+        return
+
+    # Eager tasks run their paths inside the view that queued them.
+    outer = getattr(_local, 'timings', None)
+    if outer is not None:
+        outer._stop_db()
+    rv = _local.timings = RequestTimings(view)
+    rv._start_db()
+    try:
+        yield rv
+    finally:
+        rv._stop_db()
+        _local.timings = outer
+        if outer is not None:
+            outer._start_db()
+        rv._report_budget()
+
+
+def timed_path(path):
+    """Decorator that records the timings of a code path that is not a
+    view, such as a notification or a task, like `request_timings`.
+    """
+    def decorator(f):
+        def new_f(*args, **kwargs):
+            with request_timings(path):
+                return f(*args, **kwargs)
+        return update_wrapper(new_f, f)
+    return decorator
+
+
+def count_items(count):
+    """Adds to the number of items the current path handles, such as the
+    rooms it notifies or the mentions it shows, which scales its budget.
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.items += count
+
+
+@contextmanager
+def collect_budget_violations():
+    """Records the timings of all paths while the block runs, regardless
+    of `SERVER_TIMING`, and yields a list that the sections going over
+    their budgets are appended to.
+    """
+    rv = []
+    _budget_listeners.append(rv)
+    try:
+        yield rv
+    finally:
+        _budget_listeners.remove(rv)
+
+
+def record_section(section, duration, count=1):
+    """Adds `count` calls that took `duration` seconds in total to a
+    section of the current path.
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.add(section, duration, count)
+
+
+def get_server_tag(server):
+    return server and urlparse(server).hostname or 'unknown'
+
+
+def _record_latency(server, duration):
+    with _latencies_lock:
+        rv = _latencies.get(server)
+        if rv is None:
+            rv = _latencies[server] = deque(maxlen=LATENCY_WINDOW)
+        rv.append(duration)
+
+
+def get_latency_percentile(server, pct, min_samples=20):
+    """Returns the `pct` percentile of the recent request durations to a
+    HipChat server as seen by this process, or `None` if there are not
+    enough samples yet.
+    """
+    with _latencies_lock:
+        values = list(_latencies.get(server) or ())
+    if len(values) < min_samples:
+        return None
+    return percentile(values, pct)
+
+
+def percentile(values, pct):
+    """Returns the `pct` percentile of a non-empty list of numbers."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def incr(key, tags=None):
+    metrics.incr('hipchat_ac.%s' % key, tags=tags)
+
+
+def timing(key, value, tags=None):
+    """Reports a value such as a size to the metrics backend.  Unlike
+    `timer` it is not recorded as a section of the current path.
+    """
+    metrics.timing('hipchat_ac.%s' % key, value, tags=tags)
+
+
+@contextmanager
+def timer(key, tags=None, section=True):
+    """Reports the time spent in the block to the metrics backend and,
+    if `section` is set, to the section `key` of the current path.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        metrics.timing('hipchat_ac.%s' % key, duration, tags=tags)
+        if section:
+            record_section(key, duration)
+
+
+def timed(key, section=True):
+    """Decorator version of `timer` that tags the metric with the name of
+    the decorated function.
+    """
+    def decorator(f):
+        def new_f(*args, **kwargs):
+            with timer(key, tags={'op': f.__name__}, section=section):
+                return f(*args, **kwargs)
+        return update_wrapper(new_f, f)
+    return decorator
+
+
+def http_request(endpoint, server, method, url, session=None, **kwargs):
+    """Sends a request to a HipChat server and reports its latency and
+    outcome.  `endpoint` is the kind of request (``notification``,
+    ``glance``, ``token`` or ``room``) and `server` is the base URL of the
+    HipChat server the tenant was installed from.
+    """
+    tags = {
+        'endpoint': endpoint,
+        'server': get_server_tag(server),
+    }
+    start = time.time()
+    try:
+        resp = (session or requests).request(method, url, **kwargs)
+    except requests.Timeout:
+        tags['status'] = 'timeout'
+        raise
+    except requests.RequestException:
+        tags['status'] = 'error'
+        raise
+    else:
+        tags['status'] = '%dxx' % (resp.status_code // 100)
+        return resp
+    finally:
+        duration = time.time() - start
+        metrics.timing('hipchat_ac.request.duration', duration, tags=tags)
+        metrics.incr('hipchat_ac.request', tags=tags)
+        record_section('hipchat', duration)
+        _record_latency(server, duration)
@@ -0,0 +1,281 @@
+import logging
+import requests
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from sentry.models import Activity, Project
+from sentry.tasks.base import instrumented_task
+from sentry.utils.imports import import_string
+
+from . import delivery, coalesce, mentions, stats
+from .cards import make_activity_summary_notification
+from .utils import cluster
+from .models import Tenant, Context, HipchatUser, OauthClientInvalidError, \
+     INVALID_TENANT_RETRY_DELAY
+from .plugin import send_activity_notification, update_tenant_projects
+
+
+logger = logging.getLogger(__name__)
+
+
+# For how many seconds we remember processed webhooks.  HipChat retries
+# deliveries it considers failed and those must not be processed twice.
+WEBHOOK_TTL = getattr(settings, 'HIPCHAT_SENTRY_AC_WEBHOOK_TTL', 60 * 60)
+
+# How many tenants are loaded per batch when refreshing all room infos,
+# how many of them share one connection and how many requests to HipChat
+# are made at once.
+ROOM_REFRESH_BATCH_SIZE = 500
+ROOM_REFRESH_CHUNK_SIZE = 25
+ROOM_REFRESH_CONCURRENCY = 8
+
+# How many tenants marked as invalid are checked per batch.
+INVALID_TENANT_BATCH_SIZE = 100
+
+_room_refresh_checkpoint_key = 'sentry-hipchat-ac:refresh-rooms:checkpoint'
+
+
+@stats.timed('redis', section=False)
+def _claim_webhook(idempotency_key):
+    client = cluster.get_routing_client()
+    return client.set('sentry-hipchat-ac:webhooks:%s' % idempotency_key,
+                      '1', ex=WEBHOOK_TTL, nx=True)
+
+
+@instrumented_task(name='sentry_hipchat_ac.tasks.process_webhook')
+def process_webhook(handler, tenant_id, data, sender=None, context=None,
+                    idempotency_key=None, **kwargs):
+    """Invokes a deferred webhook handler (see `views.webhook`)."""
+    if idempotency_key is not None and not _claim_webhook(idempotency_key):
+        logger.info('Skipping already processed webhook %s',
+                    idempotency_key)
+        return
+
+    try:
+        tenant = Tenant.objects.get(pk=tenant_id)
+    except Tenant.DoesNotExist:
+        return
+
+    f = import_string(handler).handler
+    with stats.request_timings('%s.handler' % f.__name__), Context(
+        tenant=tenant,
+        sender=sender and HipchatUser(**sender) or None,
+        context=context or {},
+    ) as ctx:
+        f(None, ctx, data)
+
+
+@instrumented_task(name='sentry_hipchat_ac.tasks.update_room_info')
+def update_room_info(tenant_id, **kwargs):
+    try:
+        tenant = Tenant.objects.get(pk=tenant_id)
+    except Tenant.DoesNotExist:
+        return
+    with Context.for_tenant(tenant):
+        tenant.update_room_info()
+
+
+@instrumented_task(name='sentry_hipchat_ac.tasks.clear_tenant')
+def clear_tenant(tenant_id, project_ids=(), **kwargs):
+    """Cleans up after a tenant that was replaced by a new installation
+    of the same id: updates the plugin options of the projects it was
+    detached from (see `TenantManager.detach`) and removes its mentions.
+    Everything else belongs to the new installation already, which may
+    have been authorized and subscribed in the meantime.
+    """
+    try:
+        tenant = Tenant.objects.get(pk=tenant_id)
+    except Tenant.DoesNotExist:
+        return
+    if project_ids:
+        update_tenant_projects(tenant, refresh=Project.objects.filter(
+            pk__in=project_ids))
+    mentions.clear_tenant_mentions(tenant)
+
+
+def _fetch_room_infos(tenants):
+    rv = []
+    session = requests.Session()
+    try:
+        for tenant in tenants:
+            try:
+                rv.append((tenant, tenant.get_room_info(session=session)))
+            except Exception:
+                logger.warning('Could not fetch room info for %r', tenant,
+                               exc_info=True)
+                rv.append((tenant, None))
+    finally:
+        session.close()
+    return rv
+
+
+@instrumented_task(name='sentry_hipchat_ac.tasks.refresh_all_room_info')
+def refresh_all_room_info(batch_size=ROOM_REFRESH_BATCH_SIZE,
+                          concurrency=ROOM_REFRESH_CONCURRENCY,
+                          resume=True, **kwargs):
+    """Refreshes the room info of all tenants.  Tenants are processed in
+    batches ordered by id and the last finished batch is recorded in
+    Redis, so an interrupted run continues where it left off unless
+    `resume` is disabled.  Within a batch tenants are grouped by HipChat
+    server so connections can be reused.  Returns a tuple with the number
+    of refreshed tenants and the number of failures.
+    """
+    client = cluster.get_routing_client()
+    last_id = resume and client.get(_room_refresh_checkpoint_key) or ''
+    refreshed = failed = 0
+
+    pool = ThreadPool(concurrency)
+    try:
+        while True:
+            batch = list(Tenant.objects.filter(
+                id__gt=last_id).order_by('id')[:batch_size])
+            if not batch:
+                break
+
+            by_server = {}
+            for tenant in batch:
+                by_server.setdefault(tenant.installed_from, []).append(tenant)
+            chunks = []
+            for tenants in by_server.itervalues():
+                for idx in xrange(0, len(tenants), ROOM_REFRESH_CHUNK_SIZE):
+                    chunks.append(tenants[idx:idx + ROOM_REFRESH_CHUNK_SIZE])
+
+            # Only the HTTP requests happen on the pool, database writes
+            # stay on this thread.
+            for results in pool.imap_unordered(_fetch_room_infos, chunks):
+                for tenant, room_info in results:
+                    if room_info is None:
+                        failed += 1
+                        continue
+                    changed = dict((k, v) for k, v in room_info.iteritems()
+                                   if getattr(tenant, k) != v)
+                    if changed:
+                        Tenant.objects.filter(pk=tenant.id).update(**changed)
+                    refreshed += 1
+
+            last_id = batch[-1].id
+            client.set(_room_refresh_checkpoint_key, last_id)
+    finally:
+        pool.close()
+        pool.join()
+
+    client.delete(_room_refresh_checkpoint_key)
+    return refreshed, failed
+
+
+@instrumented_task(name='sentry_hipchat_ac.tasks.sweep_invalid_tenants')
+def sweep_invalid_tenants(batch_size=INVALID_TENANT_BATCH_SIZE, **kwargs):
+    """Validates the credentials of all tenants marked as invalid and
+    deletes the ones HipChat still rejects.  Tenants that turn out to be
+    fine are unmarked; tenants that cannot be checked right now stay
+    marked and are checked again later.
+    """
+    Tenant.objects.clear_invalid_sweep()
+    ids = list(Tenant.objects.get_invalid_ids())
+    for idx in xrange(0, len(ids), batch_size):
+        batch = ids[idx:idx + batch_size]
+        tenants = dict((x.id, x) for x in Tenant.objects.filter(pk__in=batch))
+        missing = [x for x in batch if x not in tenants]
+        if missing:
+            Tenant.objects.unmark_invalid(missing)
+
+        for tenant in tenants.itervalues():
+            try:
+                tenant.get_token(token_only=False)
+            except OauthClientInvalidError:
+                logger.info('Deleting tenant %r with invalid credentials',
+                            tenant)
+                tenant.delete()
+            except Exception:
+                logger.warning('Could not validate tenant %r', tenant,
+                               exc_info=True)
+            else:
+                tenant.unmark_invalid()
+
+    # Marked tenants get no notifications, so they must not be forgotten.
+    if Tenant.objects.get_invalid_ids():
+        Tenant.objects.schedule_invalid_sweep(INVALID_TENANT_RETRY_DELAY)
+
+
+def schedule_deferred_flush(server, countdown=0):
+    """Queues `flush_deferred_deliveries` for a HipChat server in
+    `countdown` seconds unless a flush is already queued for it.
+    """
+    if delivery.claim_flush(server, countdown):
+        flush_deferred_deliveries.apply_async(
+            kwargs={'server': server}, countdown=countdown)
+
+
+@instrumented_task(name='sentry_hipchat_ac.tasks.flush_deferred_deliveries')
+def flush_deferred_deliveries(server, **kwargs):
+    """Sends the requests that were deferred for a HipChat server.  If they
+    still cannot be sent they are deferred again, which queues the next
+    flush.
+    """
+    # From here on a request that is deferred again queues a new flush.
+    delivery.release_flush(server)
+
+    tenants = {}
+    while True:
+        item = delivery.pop_deferred(server)
+        if item is None:
+            return
+
+        if item['tenant'] not in tenants:
+            tenants[item['tenant']] = Tenant.objects.filter(
+                pk=item['tenant']).first()
+        tenant = tenants[item['tenant']]
+        if tenant is None:
+            continue
+
+        resp = False
+        with Context.for_tenant(tenant) as ctx:
+            try:
+                resp = ctx.post(item['url'], item['body'],
+                                endpoint=item['endpoint'],
+                                lane=item.get('lane'))
+            except OauthClientInvalidError:
+                # The context marks the tenant invalid, the request is
+                # given up on.
+                raise
+            except requests.RequestException as e:
+                # Client errors would fail again, only requests that did
+                # not get through or hit a server error are tried later.
+                if e.response is not None and e.response.status_code < 500:
+                    logger.warning('Dropping deferred request for %r',
+                                   tenant, exc_info=True)
+                    continue
+                logger.warning('Could not send deferred request for %r',
+                               tenant, exc_info=True)
+                delivery.defer(tenant, item['url'], item['body'],
+                               item['endpoint'], item.get('lane'))
+                schedule_deferred_flush(
+                    server, countdown=delivery.BREAKER_RESET_TIMEOUT + 1)
+                return
+            except Exception:
+                logger.warning('Dropping deferred request for %r',
+                               tenant, exc_info=True)
+                continue
+        if resp is None:
+            # The breaker is open (again), the lane is full or the server
+            # failed.  The request was deferred once more and that queued
+            # the next flush.
+            return
+
+
+@instrumented_task(name='sentry_hipchat_ac.tasks.flush_activities')
+@stats.timed_path('flush_activities')
+def flush_activities(group_id, **kwargs):
+    """Sends one notification summarizing the activities collected for a
+    group (see `HipchatNotifier.notify_about_activity`).
+    """
+    ids = coalesce.pop_activities(group_id)
+    if not ids:
+        return
+    activities = list(Activity.objects.filter(pk__in=ids).select_related(
+        'user', 'group', 'project').order_by('datetime', 'id'))
+    if activities:
+        send_activity_notification(
+            activities[0].project,
+            make_activity_summary_notification(activities))
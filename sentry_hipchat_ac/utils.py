@@ -1,11 +1,89 @@
 import os
 import json
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
 from django.http import HttpResponse
 
+from . import stats
+
 
 IS_DEBUG = os.environ.get('AC_DEBUG') == '1'
 
 
+# The Redis cluster manager (``clusters``) was added in Sentry 8.2 (GH-2714)
+# and replaces ``make_rb_cluster`` (which will be removed in a future version.)
+try:
+    from sentry.utils.redis import clusters
+    _cluster = clusters.get('default')
+except ImportError:
+    from sentry.utils.redis import make_rb_cluster
+    _cluster = make_rb_cluster(settings.SENTRY_REDIS_OPTIONS['hosts'])
+
+
+class _CountingClient(object):
+    """Wraps a Redis client and counts the commands sent through it.
+    Commands of a routing client are recorded in the ``redis`` section of
+    the current path right away; those of a mapping client are only sent
+    when its block ends and are recorded by `CountingCluster.map`.
+    """
+
+    def __init__(self, client, immediate=True):
+        self._client = client
+        self._immediate = immediate
+        self.commands = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            if not self._immediate:
+                self.commands += 1
+                return attr(*args, **kwargs)
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                stats.record_section('redis', time.time() - start)
+        return command
+
+
+class CountingCluster(object):
+    """Wraps an rb cluster so that every Redis command counts towards the
+    budget of the current path, including the ones that are not sent from
+    a helper timed with `stats.timed`.
+    """
+
+    def __init__(self, cluster):
+        self._cluster = cluster
+
+    def __getattr__(self, name):
+        return getattr(self._cluster, name)
+
+    def get_routing_client(self, *args, **kwargs):
+        return _CountingClient(
+            self._cluster.get_routing_client(*args, **kwargs))
+
+    @contextmanager
+    def map(self, *args, **kwargs):
+        start = time.time()
+        client = None
+        try:
+            with self._cluster.map(*args, **kwargs) as map_client:
+                client = _CountingClient(map_client, immediate=False)
+                yield client
+        finally:
+            if client is not None and client.commands:
+                stats.record_section('redis', time.time() - start,
+                                     count=client.commands)
+
+
+cluster = CountingCluster(_cluster)
+
+
 class JsonResponse(HttpResponse):
 
     def __init__(self, value, status=200):
@@ -1,13 +1,15 @@
 import re
 import json
+import hashlib
 import requests
 from functools import update_wrapper
 from django import forms
 from django.conf import settings
+from django.core.cache import cache
 from django.views.generic import View
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
-from django.shortcuts import render
+from django.shortcuts import render as _render
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 
@@ -17,18 +19,26 @@ from sentry.models import Organization, Team, User, OrganizationMember, \
 
 from .utils import JsonResponse, IS_DEBUG
 from .models import Tenant, Context
-from . import mentions
-from .plugin import enable_plugin_for_tenant, disable_plugin_for_tenant, \
-     ADDON_HOST_IDENT
-from .cards import make_event_notification, make_generic_notification, \
-     make_subscription_update_notification, ICON, ICON2X
+from . import mentions, stats, delivery, routing
+from .tasks import process_webhook, clear_tenant, update_room_info
+from .plugin import update_tenant_projects, ADDON_HOST_IDENT
+from .cards import make_event_notification, make_event_list_notification, \
+     make_generic_notification, make_subscription_update_notification, \
+     ICON, ICON2X
 
 
 _link_pattern = re.escape(settings.SENTRY_URL_PREFIX) \
     .replace('https\\:', 'https?\\:') + '/'
 _link_re = re.compile(_link_pattern +
-    r'(?P<org>[^/]+)/(?P<proj>[^/]+)/group/'
-    r'(?P<group>[^/]+)(/events/(?P<event>[^/]+)|/?)')
+    r'(?P<org>[^/\s]+)/(?P<proj>[^/\s]+)/group/'
+    r'(?P<group>\d+)(/events/(?P<event>\d+)|/?)')
+
+# The maximum number of links that are unfurled for a single message.
+MAX_UNFURLS = getattr(settings, 'HIPCHAT_SENTRY_AC_MAX_UNFURLS', 5)
+
+# For how many seconds the capabilities documents of HipChat servers are
+# cached.
+CAPDOC_CACHE_TTL = getattr(settings, 'HIPCHAT_SENTRY_AC_CAPDOC_TTL', 60 * 60)
 
 ADDON_KEY = getattr(settings, 'HIPCHAT_SENTRY_AC_KEY', None)
 if ADDON_KEY is None:
@@ -193,6 +203,18 @@ class DescriptorView(View):
         })
 
 
+def get_capabilities(url):
+    """Fetches a capabilities document.  All installations from one
+    HipChat server share the same document so it's cached for a while.
+    """
+    cache_key = 'hipchat-capdoc:%s' % hashlib.md5(url).hexdigest()
+    rv = cache.get(cache_key)
+    if rv is None:
+        rv = requests.get(url, timeout=10).json()
+        cache.set(cache_key, rv, CAPDOC_CACHE_TTL)
+    return rv
+
+
 class InstallableView(View):
 
     @method_decorator(csrf_exempt)
@@ -207,26 +229,24 @@ class InstallableView(View):
             return HttpResponse('This add-on can only be installed in '
                                 'individual rooms.', status=400)
 
-        capdoc = requests.get(data['capabilitiesUrl'], timeout=10).json()
+        capdoc = get_capabilities(data['capabilitiesUrl'])
         if capdoc['links'].get('self') != data['capabilitiesUrl']:
             return HttpResponse('Mismatch on capabilities URL',
                                 status=400)
 
-        # Make sure we clean up an old existing tenant if we have one.
-        try:
-            old_tenant = Tenant.objects.get(pk=data['oauthId'])
-        except Tenant.DoesNotExist:
-            pass
-        else:
-            old_tenant.delete()
-
-        tenant = Tenant.objects.create(
+        # An old tenant we replace is only unlinked from its projects
+        # here; cleaning up after it and fetching the room info are left
+        # to the workers.
+        tenant_id, replaced = Tenant.objects.install(
             id=data['oauthId'],
             room_id=room_id,
             secret=data['oauthSecret'],
             capdoc=capdoc,
         )
-        tenant.update_room_info()
+        if replaced:
+            clear_tenant.delay(tenant_id=tenant_id,
+                               project_ids=Tenant.objects.detach(tenant_id))
+        update_room_info.delay(tenant_id=tenant_id)
 
         return HttpResponse('', status=201)
 
@@ -303,16 +323,16 @@ class ProjectSelectForm(forms.Form):
         return set(self.cleaned_data['projects'])
 
     def save_changes(self):
-        new_projects = []
-        removed_projects = []
-
-        for project_id, project in self.projects_by_id.iteritems():
-            if project_id in self.cleaned_data['projects']:
-                if enable_plugin_for_tenant(project, self.tenant):
-                    new_projects.append(project)
-            else:
-                if disable_plugin_for_tenant(project, self.tenant):
-                    removed_projects.append(project)
+        selected = self.cleaned_data['projects']
+        new_projects, removed_projects = update_tenant_projects(
+            self.tenant,
+            add=[project for project_id, project
+                 in self.projects_by_id.iteritems()
+                 if project_id in selected],
+            remove=[project for project_id, project
+                    in self.projects_by_id.iteritems()
+                    if project_id not in selected],
+        )
 
         if new_projects or removed_projects:
             with Context.for_tenant(self.tenant) as ctx:
@@ -324,22 +344,68 @@ class ProjectSelectForm(forms.Form):
                 ctx.push_recent_events_glance()
 
 
-def webhook(f):
-    @csrf_exempt
-    def new_f(request, *args, **kwargs):
-        data = json.loads(request.body) or {}
-        with Context.for_request(request, data) as context:
-            return f(request, context, data, *args, **kwargs)
-    return update_wrapper(new_f, f)
+def _get_webhook_key(context, data, body):
+    message_id = (data.get('item') or {}).get('message', {}).get('id')
+    if message_id is None:
+        message_id = hashlib.md5(body).hexdigest()
+    return '%s:%s:%s' % (context.tenant.id, data.get('webhook_id'),
+                         message_id)
+
+
+def webhook(f=None, deferred=False):
+    """Turns a function into a webhook view.  If `deferred` is set the
+    request is only authenticated and the payload is handed to a worker
+    which invokes the function with `request` set to `None`.  Webhooks
+    retried by HipChat are only processed once in that case.
+    """
+    def decorator(f):
+        @csrf_exempt
+        def new_f(request, *args, **kwargs):
+            data = json.loads(request.body) or {}
+            with stats.request_timings(f.__name__) as timings, \
+                    Context.for_request(request, data) as context:
+                if not deferred:
+                    return timings.finish(
+                        f(request, context, data, *args, **kwargs))
+                sender = context.sender
+                process_webhook.delay(
+                    handler='%s.%s' % (f.__module__, f.__name__),
+                    tenant_id=context.tenant.id,
+                    data=data,
+                    sender=sender and {
+                        'id': sender.id,
+                        'name': sender.name,
+                        'mention_name': sender.mention_name,
+                    } or None,
+                    context=context.context,
+                    idempotency_key=_get_webhook_key(
+                        context, data, request.body),
+                )
+                return timings.finish(HttpResponse('', status=204))
+        new_f = update_wrapper(new_f, f)
+        new_f.handler = f
+        return new_f
+
+    if f is not None:
+        return decorator(f)
+    return decorator
 
 
 def with_context(f):
     def new_f(request, *args, **kwargs):
-        with Context.for_request(request) as context:
-            return f(request, context, *args, **kwargs)
+        with stats.request_timings(f.__name__) as timings:
+            with stats.timer('auth'):
+                context = Context.for_request(request)
+            with context:
+                return timings.finish(f(request, context, *args, **kwargs))
     return update_wrapper(new_f, f)
 
 
+def render(request, template_name, context):
+    with stats.timer('template'):
+        return _render(request, template_name, context)
+
+
 def allow_frame(f):
     def new_f(request, *args, **kwargs):
         resp = f(request, *args, **kwargs)
@@ -364,6 +430,7 @@ def cors(f):
 
 
 @allow_frame
+@routing.read_only_view
 @with_context
 def configure(request, context):
     # XXX: this is a bit terrible because it means the login url is
@@ -389,6 +456,9 @@ def configure(request, context):
             project_select_form.save_changes()
             return HttpResponseRedirect(request.get_full_path())
 
+    delivery_log, delivery_summary = delivery.get_delivery_log(
+        context.tenant)
+
     return render(request, 'sentry_hipchat_ac/configure.html', {
         'context': context,
         'tenant': context.tenant,
@@ -396,6 +466,8 @@ def configure(request, context):
         'grant_form': grant_form,
         'project_select_form': project_select_form,
         'available_orgs': list(context.tenant.organizations.all()),
+        'delivery_log': delivery_log,
+        'delivery_summary': delivery_summary,
         'hipchat_debug': IS_DEBUG,
     })
 
@@ -424,12 +496,14 @@ def sign_out(request, context):
 
 @cors
 @allow_frame
+@routing.read_only_view
 @with_context
 def recent_events_glance(request, context):
     return JsonResponse(context.get_recent_events_glance())
 
 
 @allow_frame
+@routing.read_only_view
 @with_context
 def event_details(request, context):
     event = None
@@ -517,6 +591,7 @@ def assign_event(request, context):
 
 
 @allow_frame
+@routing.read_only_view
 @with_context
 def recent_events(request, context):
     events = mentions.get_recent_mentions(context.tenant)
@@ -526,29 +601,72 @@ def recent_events(request, context):
     })
 
 
-@webhook
+@webhook(deferred=True)
 def on_link_message(request, context, data):
-    match = _link_re.search(data['item']['message']['message'])
-    if match is not None:
+    links = []
+    for match in _link_re.finditer(data['item']['message']['message']):
         params = match.groupdict()
-        event = context.get_event_from_url_params(
-            group_id=params['group'],
-            event_id=params['event'],
-            slug_vars={'org_slug': params['org'],
-                       'proj_slug': params['proj']}
-        )
-        if event is not None:
+        try:
+            params['mention_id'] = mentions.get_mention_id(
+                int(params['group']),
+                params['event'] is not None and int(params['event']) or None)
+        except ValueError:
+            continue
+        if params['mention_id'] not in [x['mention_id'] for x in links]:
+            links.append(params)
+            if len(links) >= MAX_UNFURLS:
+                break
+    stats.count_items(len(links))
+
+    # Links that were recently unfurled in this room are only moved up
+    # in the list of recent mentions.
+    fresh = links and mentions.claim_unfurls(
+        context.tenant, context.room_id,
+        [x['mention_id'] for x in links]) or set()
+    repeated = [x['mention_id'] for x in links
+                if x['mention_id'] not in fresh]
+    if repeated:
+        mentions.touch_mentions(context.tenant, repeated)
+    links = [x for x in links if x['mention_id'] in fresh]
+
+    resolved = links and context.get_events_from_url_params(links) or []
+    if len(resolved) < len(links):
+        resolved_ids = set(params['mention_id'] for params, _ in resolved)
+        mentions.release_unfurls(
+            context.tenant, context.room_id,
+            [x['mention_id'] for x in links
+             if x['mention_id'] not in resolved_ids])
+
+    # If the card cannot be sent the claims are released so that the links
+    # are unfurled the next time they are posted.
+    try:
+        if len(resolved) == 1:
+            params, event = resolved[0]
             context.send_notification(**make_event_notification(
                 event.group, event, context.tenant, new=False,
                 event_target=params['event'] is not None))
-
-            mentions.mention_event(
-                project=event.project,
-                group=event.group,
-                tenant=context.tenant,
-                event=params['event'] and event or None,
-            )
-            context.push_recent_events_glance()
+        elif resolved:
+            context.send_notification(**make_event_list_notification([
+                (event, params['event'] is not None)
+                for params, event in resolved]))
+    except Exception:
+        mentions.release_unfurls(
+            context.tenant, context.room_id,
+            [params['mention_id'] for params, _ in resolved])
+        raise
+
+    count = None
+    for params, event in resolved:
+        count = mentions.mention_event(
+            project=event.project,
+            group=event.group,
+            tenant=context.tenant,
+            event=params['event'] and event or None,
+            snapshot=mentions.make_snapshot(event.project, event.group,
+                                            event),
+        )
+    if resolved:
+        context.push_recent_events_glance(count)
 
     return HttpResponse('', status=204)
 
@@ -0,0 +1,22 @@
+from __future__ import absolute_import
+
+import pytest
+
+
+pytest_plugins = [
+    'sentry.utils.pytest',
+]
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_configure(config):
+    from django.conf import settings
+    settings.INSTALLED_APPS = tuple(settings.INSTALLED_APPS) + (
+        'sentry_hipchat_ac',
+    )
+
+    # The plugin has to be registered before Sentry's URLs are loaded so
+    # that the add-on views are mounted.
+    from sentry.plugins import plugins
+    from sentry_hipchat_ac.plugin import HipchatNotifier
+    plugins.register(HipchatNotifier)
@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+
+import json
+
+from django.core.urlresolvers import reverse
+from mock import patch
+
+from sentry.models import Activity
+from sentry.plugins import plugins
+from sentry.testutils import TestCase
+
+from sentry_hipchat_ac import coalesce, stats
+from sentry_hipchat_ac.bench.fakehipchat import FakeHipChat
+from sentry_hipchat_ac.bench.notify import count_deliveries
+from sentry_hipchat_ac.bench.views import create_view_tenants, \
+     make_link_message
+from sentry_hipchat_ac.tasks import flush_activities, process_webhook
+
+
+class BudgetTest(TestCase):
+    """Runs every path against a fake HipChat server with a few rooms
+    subscribed and fails if it goes over its budget in `stats.BUDGETS`.
+    """
+
+    rooms = 3
+
+    def setUp(self):
+        self.fake = FakeHipChat().start()
+        self.addCleanup(self.fake.stop)
+        self.plugin = plugins.get('hipchat-ac')
+        self.tenants = create_view_tenants(
+            self.fake, self.rooms, self.project, self.user,
+            [(self.group, self.event)])
+        self.tenant = self.tenants[0]
+
+    def run_path(self, path, f, *args, **kwargs):
+        with stats.collect_budget_violations() as violations, \
+                patch.object(stats, 'request_timings',
+                             wraps=stats.request_timings) as timings:
+            rv = f(*args, **kwargs)
+        assert path in [x[0][0] for x in timings.call_args_list]
+        assert violations == []
+        return rv
+
+    def signed_get(self, view, **params):
+        params['signed_request'] = self.tenant.sign_jwt(1)
+        return self.client.get(reverse(view), params)
+
+    def test_violations_are_collected(self):
+        with patch.dict(stats.BUDGETS['notify_users'], redis=(0, 0)), \
+                stats.collect_budget_violations() as violations:
+            self.plugin.notify_users(self.group, self.event)
+        assert ('notify_users', 'redis') in [
+            (x['path'], x['section']) for x in violations]
+
+    def test_recent_events_glance(self):
+        resp = self.run_path(
+            'recent_events_glance', self.signed_get,
+            'sentry-hipchat-ac-recent-events-glance')
+        assert resp.status_code == 200
+
+    def test_recent_events(self):
+        resp = self.run_path('recent_events', self.signed_get,
+                             'sentry-hipchat-ac-recent-events')
+        assert resp.status_code == 200
+
+    def test_event_details(self):
+        resp = self.run_path('event_details', self.signed_get,
+                             'sentry-hipchat-ac-event-details',
+                             event=self.event.id)
+        assert resp.status_code == 200
+
+    def test_assign_event(self):
+        resp = self.run_path('assign_event', self.signed_get,
+                             'sentry-hipchat-assign-event',
+                             event=self.event.id)
+        assert resp.status_code == 200
+
+    def test_configure(self):
+        resp = self.run_path('configure', self.signed_get,
+                             'sentry-hipchat-ac-config')
+        assert resp.status_code == 200
+
+    def test_on_link_message(self):
+        body = make_link_message(self.tenant, 1, [(self.group, self.event)])
+        with patch.object(process_webhook, 'delay') as delay:
+            resp = self.run_path(
+                'on_link_message', self.client.post,
+                reverse('sentry-hipchat-ac-link-message'),
+                json.dumps(body), content_type='application/json',
+                HTTP_AUTHORIZATION='JWT %s' % self.tenant.sign_jwt(1))
+        assert resp.status_code == 204
+
+        self.run_path('on_link_message.handler', process_webhook,
+                      **delay.call_args[1])
+        assert count_deliveries(self.fake) == 1
+
+    def test_notify_users(self):
+        self.run_path('notify_users', self.plugin.notify_users,
+                      self.group, self.event)
+        assert count_deliveries(self.fake) == self.rooms
+
+    def test_notify_users_cooling_down(self):
+        self.plugin.notify_users(self.group, self.event)
+        self.run_path('notify_users', self.plugin.notify_users,
+                      self.group, self.event)
+        assert count_deliveries(self.fake) == self.rooms
+
+    def test_notify_about_activity(self):
+        activity = Activity.objects.create(
+            project=self.project, group=self.group, type=Activity.NOTE,
+            user=self.user, data={'text': 'Looking into it'})
+        with patch.object(coalesce, 'ACTIVITY_WINDOW', 0):
+            self.run_path('notify_about_activity',
+                          self.plugin.notify_about_activity, activity)
+        assert count_deliveries(self.fake) == self.rooms
+
+    def test_flush_activities(self):
+        activities = [Activity.objects.create(
+            project=self.project, group=self.group, type=Activity.NOTE,
+            user=self.user, data={'text': 'Note %d' % idx})
+            for idx in xrange(3)]
+        for activity in activities:
+            coalesce.buffer_activity(activity)
+        self.run_path('flush_activities', flush_activities,
+                      group_id=self.group.id)
+        assert count_deliveries(self.fake) == self.rooms
@@ -0,0 +1,19 @@
+from __future__ import absolute_import
+
+from sentry.testutils import TestCase
+
+from sentry_hipchat_ac.bench.views import make_link
+from sentry_hipchat_ac.views import _link_re
+
+
+class LinkMessageTest(TestCase):
+
+    def test_finds_every_link_in_a_message(self):
+        other = self.create_group(project=self.project)
+        message = 'see %s and %s ok' % (make_link(self.group),
+                                         make_link(other, self.event))
+        assert [(x.group('group'), x.group('event'))
+                for x in _link_re.finditer(message)] == [
+            (str(self.group.id), None),
+            (str(other.id), str(self.event.id)),
+        ]